@@ -0,0 +1,300 @@
+"""
+Benchmark the backend hot paths in-process over ASGI, with synthetic quotes and a mock LLM.
+
+    python benchmarks/bench_api.py --output results.json
+    python benchmarks/bench_api.py --sizes 10,1000 --compare results.json
+
+Each scenario reports throughput, latency percentiles and peak traced allocation per request as JSON,
+so runs from different commits can be compared with --compare (non-zero exit on regression).
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+WORK_DIR = tempfile.mkdtemp(prefix="portfolio-bench-")
+
+# main.py reads its configuration at import time, so the benchmark environment must be in place first
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{WORK_DIR}/bench.db"
+os.environ["PRICE_HISTORY_DIR"] = os.path.join(WORK_DIR, "price_history")
+os.environ["PRICE_STREAM_ENABLED"] = "false"
+os.environ["MARKET_DATA_PROVIDER"] = "synthetic"
+os.environ["LLM_PROVIDER"] = "openai"
+os.environ["OPENAI_API_KEY"] = "bench"
+os.environ.setdefault("QUOTE_CACHE_TTL", "3600")
+os.environ.setdefault("QUOTE_CACHE_STALE_TTL", "3600")
+os.environ.setdefault("QUOTE_CACHE_MAX_SIZE", "100000")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import httpx  # noqa: E402
+import main  # noqa: E402
+
+SCENARIOS = ("portfolio_stocks", "portfolio_stocks_304", "stock_detail", "import_csv", "assistant_chat", "assistant_chat_stream")
+
+# --- Mock LLM ---
+def mock_llm_transport(latency_ms: float, tokens: int) -> httpx.MockTransport:
+    """OpenAI-compatible chat completions endpoint answering after `latency_ms`, streaming `tokens` chunks."""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency_ms / 1000)
+        if json.loads(request.content).get("stream"):
+            async def chunks():
+                for i in range(tokens):
+                    yield f'data: {json.dumps({"choices": [{"delta": {"content": f"tok{i} "}}]})}\n\n'.encode()
+                yield b"data: [DONE]\n\n"
+            return httpx.Response(200, content=chunks(), headers={"Content-Type": "text/event-stream"})
+        reply = " ".join(f"tok{i}" for i in range(tokens))
+        return httpx.Response(200, json={"choices": [{"message": {"content": reply}}]})
+    return httpx.MockTransport(handler)
+
+# --- Fixtures ---
+def synthetic_holdings(size: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [
+        {"symbol": f"S{i:05d}", "quantity": float(rng.randint(1, 500)), "unit_cost": round(rng.uniform(5, 500), 2)}
+        for i in range(size)
+    ]
+
+def holdings_csv(holdings: list) -> bytes:
+    lines = ["Symbol,Quantity,Unit Cost"]
+    lines.extend(f"{h['symbol']},{h['quantity']},{h['unit_cost']}" for h in holdings)
+    return ("\n".join(lines) + "\n").encode()
+
+async def create_portfolio(client: httpx.AsyncClient, name: str, holdings: list) -> int:
+    resp = await client.post("/portfolios/", json={"name": name})
+    resp.raise_for_status()
+    portfolio_id = resp.json()["id"]
+    if holdings:
+        async with main.async_session() as session:
+            async with session.begin():
+                await session.execute(main.sa.insert(main.Stock), [{"portfolio_id": portfolio_id, **h} for h in holdings])
+    resp = await client.put("/portfolio/cash/", params={"portfolio_id": portfolio_id}, json={"cash": 10000.0})
+    resp.raise_for_status()
+    # Loads the valuation and warms the quote cache so scenarios measure the steady state
+    resp = await client.get("/portfolio/stocks/", params={"portfolio_id": portfolio_id})
+    resp.raise_for_status()
+    return portfolio_id
+
+# --- Measurement ---
+def percentile(sorted_values: list, q: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))]
+
+async def run_requests(send, requests: int, concurrency: int) -> tuple:
+    """Issue `requests` calls of send(i) from `concurrency` workers. Returns (latencies_ms, errors, wall_seconds)."""
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                ok = await send(i)
+            except Exception:
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += 0 if ok else 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+async def peak_allocation_kb(send, requests: int) -> float:
+    """Peak traced Python allocation while running `requests` sequential calls, in KiB."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for i in range(requests):
+            await send(i)
+        return round((tracemalloc.get_traced_memory()[1] - baseline) / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+# --- Scenarios ---
+def build_scenario(name: str, client: httpx.AsyncClient, portfolio_id: int, holdings: list, seed: int):
+    """Return send(i) -> bool for a scenario, or None if it does not apply to this portfolio."""
+    params = {"portfolio_id": portfolio_id}
+    rng = random.Random(seed)
+    symbols = [h["symbol"] for h in holdings]
+
+    if name == "portfolio_stocks":
+        async def send(i):
+            # Move one price first so every request re-values and re-serializes, as a live dashboard poll would
+            if symbols:
+                main.quote_cache.set(symbols[i % len(symbols)], round(rng.uniform(5, 500), 2))
+            return (await client.get("/portfolio/stocks/", params=params)).status_code == 200
+        return send
+
+    if name == "portfolio_stocks_304":
+        etag = {"value": ""}
+        async def send(i):
+            # The warm-up call picks up the current ETag; later polls should all be answered with 304
+            resp = await client.get("/portfolio/stocks/", params=params, headers={"If-None-Match": etag["value"]})
+            etag["value"] = resp.headers["etag"]
+            return resp.status_code == 304
+        return send
+
+    if name == "stock_detail":
+        if not symbols:
+            return None
+        async def send(i):
+            resp = await client.get(f"/portfolio/stocks/{rng.choice(symbols)}", params=params)
+            return resp.status_code == 200
+        return send
+
+    if name == "import_csv":
+        body = holdings_csv(holdings)
+        async def send(i):
+            # Imports run as background jobs: time submission through completion
+            files = {"file": ("holdings.csv", body, "text/csv")}
+            resp = await client.post("/portfolio/import-csv/", params=params, files=files, data={"mode": "replace"})
+            job = resp.json()
+            while job["status"] in ("queued", "running"):
+                await asyncio.sleep(0.005)
+                job = (await client.get(f"/jobs/{job['id']}")).json()
+            return job["status"] == "succeeded"
+        return send
+
+    if name in ("assistant_chat", "assistant_chat_stream"):
+        stream = name == "assistant_chat_stream"
+        async def send(i):
+            payload = {"messages": [{"role": "user", "content": f"Question {i}: how diversified am I?"}], "stream": stream, "cache": False}
+            resp = await client.post("/assistant/chat", params=params, json=payload)
+            return resp.status_code == 200 and (not stream or "event: done" in resp.text)
+        return send
+
+    raise ValueError(f"Unknown scenario: {name}")
+
+async def run_benchmarks(args) -> dict:
+    results = []
+    async with main.app.router.lifespan_context(main.app):
+        main.llm_http_client = httpx.AsyncClient(transport=mock_llm_transport(args.llm_latency_ms, args.llm_tokens))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for size in args.sizes:
+                holdings = synthetic_holdings(size, args.seed)
+                portfolio_id = await create_portfolio(client, f"bench-{size}", holdings)
+                for name in args.scenarios:
+                    send = build_scenario(name, client, portfolio_id, holdings, args.seed)
+                    if send is None:
+                        continue
+                    requests = args.import_requests if name == "import_csv" else args.requests
+                    concurrency = 1 if name == "import_csv" else args.concurrency
+                    await send(-1)  # warm-up
+                    latencies, errors, wall = await run_requests(send, requests, concurrency)
+                    latencies.sort()
+                    result = {
+                        "scenario": name,
+                        "holdings": size,
+                        "requests": requests,
+                        "concurrency": concurrency,
+                        "errors": errors,
+                        "throughput_rps": round(requests / wall, 2) if wall else 0.0,
+                        "latency_ms": {
+                            "mean": round(sum(latencies) / len(latencies), 3),
+                            "p50": round(percentile(latencies, 0.50), 3),
+                            "p90": round(percentile(latencies, 0.90), 3),
+                            "p99": round(percentile(latencies, 0.99), 3),
+                            "max": round(latencies[-1], 3),
+                        },
+                        "peak_alloc_kb": await peak_allocation_kb(send, args.memory_requests) if args.memory_requests else None,
+                    }
+                    results.append(result)
+                    print(
+                        f"{name:<22} {size:>6} holdings  {result['throughput_rps']:>9.1f} req/s  "
+                        f"p50 {result['latency_ms']['p50']:>9.2f} ms  p99 {result['latency_ms']['p99']:>9.2f} ms  "
+                        f"peak {result['peak_alloc_kb']} KiB  errors {errors}",
+                        file=sys.stderr,
+                    )
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# --- Comparison ---
+def compare(current: dict, baseline: dict, max_regression: float) -> list:
+    """Return a description of every scenario whose p99 latency or throughput regressed beyond max_regression."""
+    previous = {(r["scenario"], r["holdings"]): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get((result["scenario"], result["holdings"]))
+        if before is None:
+            continue
+        label = f"{result['scenario']} @ {result['holdings']}"
+        p99, p99_before = result["latency_ms"]["p99"], before["latency_ms"]["p99"]
+        rps, rps_before = result["throughput_rps"], before["throughput_rps"]
+        print(f"{label:<32} p99 {p99_before:.2f} -> {p99:.2f} ms   throughput {rps_before:.1f} -> {rps:.1f} req/s", file=sys.stderr)
+        if p99_before and p99 > p99_before * (1 + max_regression):
+            regressions.append(f"{label}: p99 {p99_before:.2f} -> {p99:.2f} ms")
+        if rps_before and rps < rps_before * (1 - max_regression):
+            regressions.append(f"{label}: throughput {rps_before:.1f} -> {rps:.1f} req/s")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,10000,50000", help="comma-separated portfolio sizes (holdings)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario and size")
+    parser.add_argument("--import-requests", type=int, default=3, help="requests for import_csv, which rewrites the whole portfolio")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients (import_csv always runs with 1)")
+    parser.add_argument("--memory-requests", type=int, default=2, help="requests traced for peak allocation (0 disables)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="mock LLM response latency")
+    parser.add_argument("--llm-tokens", type=int, default=50, help="tokens in each mock LLM reply")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON results; exit 1 if any scenario regressed")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed fractional p99/throughput regression")
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmarks(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
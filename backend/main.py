@@ -1,31 +1,260 @@
-from fastapi import FastAPI, HTTPException, Depends, Path, Body, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, Path, Query, Body, UploadFile, File, Form, Request
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 import requests
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column, selectinload
 from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 import sqlalchemy as sa
+import numpy as np
 import asyncio
+import random
+import time
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from dotenv import load_dotenv
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import finnhub
 import httpx
 import csv
-from io import StringIO
+import io
+import codecs
+from collections import OrderedDict, deque
 import unicodedata
+import json
+import zlib
+import re
+from datetime import datetime
+import hashlib
+import uuid
+import shutil
+import tempfile
+import threading
+import logging
+import copy
+import bisect
+import cProfile
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from functools import lru_cache
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
 # Configuration for Finnhub API
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY")
 
 # Finnhub client (global, reuse for all requests)
 finnhub_client = finnhub.Client(api_key=FINNHUB_API_KEY) if FINNHUB_API_KEY else None
 
-DATABASE_URL = "sqlite+aiosqlite:///./portfolio.db"
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+# --- Metrics ---
+# Process-local metrics in the Prometheus text format, served at GET /metrics.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # fraction of requests run under cProfile
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+
+metrics_registry: list = []
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Metric:
+    """
+    A named metric with one value per combination of label values. `collect`, if given, is called at
+    scrape time and returns {label values tuple: value}, for figures other components already count.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values: dict = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self._values
+        for key, value in values.items():
+            yield "", self.labelnames, key, value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {value}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]  # per-bucket counts (+Inf last), sum
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, key + ("+Inf" if bound == float("inf") else repr(bound),), cumulative
+            yield "_sum", self.labelnames, key, total
+            yield "_count", self.labelnames, key, cumulative
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in metrics_registry for line in metric.render()) + "\n"
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route template (streams count until closed).", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served, including open streams.")
+DB_LATENCY = Histogram("db_query_duration_seconds", "Database statement latency by SQL operation.", ("operation",))
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Calls to Finnhub and the LLM provider by outcome (ok, error, rate_limited).", ("service", "method", "outcome"))
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds", "Latency of calls to Finnhub and the LLM provider.", ("service", "method"))
+STAGE_LATENCY = Histogram("stage_duration_seconds", "Time spent in named stages of the portfolio, quote, LLM and CSV import paths.", ("stage",))
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route template, optionally under a sampling profiler."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profiler = _start_request_profiler()
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec()
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_LATENCY.observe(elapsed, method=scope["method"], route=route)
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status)
+            if profiler is not None:
+                _finish_request_profiler(profiler, scope["method"], route)
+
+_active_profiler: Optional[cProfile.Profile] = None
+
+def _start_request_profiler() -> Optional[cProfile.Profile]:
+    """
+    Profile a PROFILE_SAMPLE_RATE fraction of requests, one at a time. The profiler sees every coroutine
+    the event loop runs meanwhile, so concurrent requests show up in the same profile.
+    """
+    global _active_profiler
+    if PROFILE_SAMPLE_RATE <= 0 or _active_profiler is not None or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    _active_profiler = cProfile.Profile()
+    _active_profiler.enable()
+    return _active_profiler
+
+def _finish_request_profiler(profiler: cProfile.Profile, method: str, route: str):
+    global _active_profiler
+    profiler.disable()
+    _active_profiler = None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{method}-{name}.prof"))
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start"].pop()
+    DB_LATENCY.observe(time.perf_counter() - start, operation=statement.lstrip().split(None, 1)[0].upper())
+
+def _handle_cursor_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time so the stack stays balanced
+    conn = exception_context.connection
+    if conn is not None and exception_context.statement is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+# --- Database ---
+# SQLite by default; set DATABASE_URL=postgresql+asyncpg://... (with asyncpg installed) to use PostgreSQL.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./portfolio.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside a writer; busy_timeout waits out short write locks
+    # instead of failing with "database is locked".
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+def create_db_engine(url: str):
+    """Create the async engine with a sized pool, tuning SQLite connections as they are opened."""
+    is_sqlite = url.startswith("sqlite")
+    kwargs = {"echo": False, "future": True}
+    if is_sqlite:
+        kwargs["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "cached_statements": SQLITE_CACHED_STATEMENTS}
+    if ":memory:" not in url:
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=not is_sqlite)
+    db_engine = create_async_engine(url, **kwargs)
+    sa.event.listen(db_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    sa.event.listen(db_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    sa.event.listen(db_engine.sync_engine, "handle_error", _handle_cursor_error)
+    if is_sqlite:
+        sa.event.listen(db_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
+
+engine = create_db_engine(DATABASE_URL)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
@@ -37,23 +266,62 @@ app.add_middleware(
     allow_origins=["http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag"]
 )
+app.add_middleware(MetricsMiddleware)
+
+# Portfolio used when a request does not pass ?portfolio_id=
+DEFAULT_PORTFOLIO_ID = 1
+
+# SQLAlchemy model for Portfolio (one per user portfolio)
+class Portfolio(Base):
+    __tablename__ = "portfolios"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(sa.String)
+    owner: Mapped[Optional[str]] = mapped_column(sa.String, nullable=True, index=True)
 
 # SQLAlchemy model for Stock
 class Stock(Base):
     __tablename__ = "stocks"
+    __table_args__ = (sa.Index("ix_stocks_portfolio_id_symbol", "portfolio_id", "symbol", unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    symbol: Mapped[str] = mapped_column(sa.String, unique=True, index=True)
+    portfolio_id: Mapped[int] = mapped_column(sa.ForeignKey("portfolios.id"), default=DEFAULT_PORTFOLIO_ID)
+    symbol: Mapped[str] = mapped_column(sa.String, index=True)
     quantity: Mapped[float] = mapped_column(sa.Float)
     unit_cost: Mapped[Optional[float]] = mapped_column(sa.Float, nullable=True)
 
-# SQLAlchemy model for PortfolioMeta (singleton for cash)
+# SQLAlchemy model for PortfolioMeta (one row per portfolio, holds cash)
 class PortfolioMeta(Base):
     __tablename__ = "portfolio_meta"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    portfolio_id: Mapped[int] = mapped_column(sa.ForeignKey("portfolios.id"), unique=True, index=True)
     cash: Mapped[float] = mapped_column(sa.Float, default=0.0)
 
+# SQLAlchemy model for SymbolProfile (per-symbol reference data shared by all portfolios)
+class SymbolProfile(Base):
+    __tablename__ = "symbol_profiles"
+    symbol: Mapped[str] = mapped_column(sa.String, primary_key=True)
+    sector: Mapped[Optional[str]] = mapped_column(sa.String, nullable=True)
+    currency: Mapped[Optional[str]] = mapped_column(sa.String, nullable=True)
+
+# Hot-path lookups, built once with bind parameters so each request reuses the compiled statement
+STOCK_BY_PORTFOLIO_SYMBOL = select(Stock).where(Stock.portfolio_id == sa.bindparam("portfolio_id"), Stock.symbol == sa.bindparam("symbol"))
+META_BY_PORTFOLIO = select(PortfolioMeta).where(PortfolioMeta.portfolio_id == sa.bindparam("portfolio_id"))
+CASH_BY_PORTFOLIO = select(PortfolioMeta.cash).where(PortfolioMeta.portfolio_id == sa.bindparam("portfolio_id"))
+HOLDINGS_BY_PORTFOLIO = (
+    select(Stock.symbol, Stock.quantity, Stock.unit_cost)
+    .where(Stock.portfolio_id == sa.bindparam("portfolio_id"))
+    .order_by(Stock.id)
+)
+HELD_SYMBOLS = select(Stock.symbol).distinct()
+
+def dialect_insert(table):
+    """INSERT supporting on_conflict_do_update for the configured backend (SQLite or PostgreSQL)."""
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
 # Pydantic model for basic stock data (input)
 class StockBase(BaseModel):
     symbol: str
@@ -70,6 +338,14 @@ class StockPortfolioItem(StockBase):
 class CashResponse(BaseModel):
     cash: float
 
+# Pydantic models for portfolios
+class PortfolioCreate(BaseModel):
+    name: str
+    owner: Optional[str] = None
+
+class PortfolioResponse(PortfolioCreate):
+    id: int
+
 # Pydantic model for the overall portfolio response
 class PortfolioDetailResponse(BaseModel):
     stocks: List[StockPortfolioItem]
@@ -85,114 +361,779 @@ async def get_session() -> AsyncSession:
 async def on_startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    # Ensure singleton PortfolioMeta row exists
+    # Ensure the default portfolio and its PortfolioMeta row exist
     async with async_session() as session:
-        result = await session.execute(select(PortfolioMeta))
+        if await session.get(Portfolio, DEFAULT_PORTFOLIO_ID) is None:
+            session.add(Portfolio(id=DEFAULT_PORTFOLIO_ID, name="Default"))
+            await session.flush()
+            if engine.dialect.name == "postgresql":
+                # An explicit id does not advance the serial sequence; move it past the seeded row
+                await session.execute(sa.text(
+                    "SELECT setval(pg_get_serial_sequence('portfolios', 'id'), (SELECT MAX(id) FROM portfolios))"
+                ))
+        result = await session.execute(META_BY_PORTFOLIO, {"portfolio_id": DEFAULT_PORTFOLIO_ID})
         meta = result.scalar_one_or_none()
         if not meta:
-            meta = PortfolioMeta(cash=0.0)
+            meta = PortfolioMeta(portfolio_id=DEFAULT_PORTFOLIO_ID, cash=0.0)
             session.add(meta)
-            await session.commit()
+        await session.commit()
+    if PRICE_STREAM_ENABLED:
+        price_streamer.start()
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await job_queue.stop()
+    await price_streamer.stop()
+    await close_llm_http_client()
 
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Finance Portfolio API"}
 
-async def get_current_stock_price(symbol: str) -> Optional[float]:
-    """Fetches the current stock price for a given symbol from Finnhub."""
-    if not FINNHUB_API_KEY or not finnhub_client:
-        print("WARNING: Finnhub API key not set. Using placeholder data.")
-        # Placeholder logic if API key is not set, useful for initial testing without a key
-        if symbol.upper() == "AAPL": return 150.00
-        if symbol.upper() == "MSFT": return 300.00
-        if symbol.upper() == "GOOGL": return 2700.00
-        return None
-    try:
-        quote = await asyncio.to_thread(finnhub_client.quote, symbol.upper())
-        price = quote.get("c")
-        if price is not None and price != 0:
-            return float(price)
-        else:
-            print(f"Price not found in Finnhub response for {symbol}. Data: {quote}")
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint."""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- Quote fetching ---
+# Finnhub's free tier allows 60 calls/minute; concurrency bounds in-flight calls on top of that.
+FINNHUB_CALLS_PER_MINUTE = int(os.getenv("FINNHUB_CALLS_PER_MINUTE", "60"))
+FINNHUB_MAX_CONCURRENCY = int(os.getenv("FINNHUB_MAX_CONCURRENCY", "8"))
+FINNHUB_MAX_RETRIES = int(os.getenv("FINNHUB_MAX_RETRIES", "3"))
+FINNHUB_RETRY_BASE_DELAY = float(os.getenv("FINNHUB_RETRY_BASE_DELAY", "1.0"))
+
+class TokenBucket:
+    """Async token bucket allowing `rate` calls per `period` seconds, with bursts up to `capacity`."""
+    def __init__(self, rate: float, period: float = 60.0, capacity: Optional[float] = None):
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.refill_per_second = rate / period
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    async def acquire(self, reserve: float = 0.0):
+        """Take one token. With `reserve`, only take it while more than `reserve` tokens are left for other callers."""
+        while True:
+            async with self._lock:
+                self._refill()
+                if self.tokens >= 1 + reserve:
+                    self.tokens -= 1
+                    return
+                wait = (1 + reserve - self.tokens) / self.refill_per_second
+            await asyncio.sleep(wait)
+
+finnhub_rate_limiter = TokenBucket(rate=FINNHUB_CALLS_PER_MINUTE)
+finnhub_semaphore = asyncio.Semaphore(FINNHUB_MAX_CONCURRENCY)
+
+async def call_finnhub(method: str, *args, low_priority: bool = False, **kwargs):
+    """
+    Call a finnhub.Client method under the rate limiter and concurrency bound, retrying 429s with backoff.
+    Low-priority (background) calls only spend tokens while over half the bucket is left, so quotes go first.
+    """
+    reserve = finnhub_rate_limiter.capacity / 2 if low_priority else 0.0
+    for attempt in range(FINNHUB_MAX_RETRIES + 1):
+        await finnhub_rate_limiter.acquire(reserve)
+        async with finnhub_semaphore:
+            start = time.perf_counter()
+            try:
+                result = await asyncio.to_thread(getattr(finnhub_client, method), *args, **kwargs)
+                UPSTREAM_REQUESTS.inc(service="finnhub", method=method, outcome="ok")
+                return result
+            except finnhub.FinnhubAPIException as e:
+                UPSTREAM_REQUESTS.inc(service="finnhub", method=method, outcome="rate_limited" if e.status_code == 429 else "error")
+                if e.status_code != 429 or attempt == FINNHUB_MAX_RETRIES:
+                    raise
+            except Exception:
+                UPSTREAM_REQUESTS.inc(service="finnhub", method=method, outcome="error")
+                raise
+            finally:
+                UPSTREAM_LATENCY.observe(time.perf_counter() - start, service="finnhub", method=method)
+        delay = FINNHUB_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, FINNHUB_RETRY_BASE_DELAY)
+        logger.warning("Finnhub rate limit hit for %s, retrying in %.1fs", method, delay)
+        await asyncio.sleep(delay)
+
+# --- Market data providers ---
+# Quotes come from a pluggable provider. "synthetic" needs no API key and can replay recorded prices
+# and inject latency/errors, so the pricing path can be load-tested offline without burning quota.
+# Its prices are made up: it is only used when asked for explicitly, and never recorded as history.
+MARKET_DATA_PROVIDER = os.getenv("MARKET_DATA_PROVIDER", "finnhub")  # Supported: "finnhub", "synthetic"
+MARKET_DATA_SEED = int(os.getenv("MARKET_DATA_SEED", "0"))
+MARKET_DATA_VOLATILITY = float(os.getenv("MARKET_DATA_VOLATILITY", "0.002"))
+MARKET_DATA_LATENCY_MS = float(os.getenv("MARKET_DATA_LATENCY_MS", "0"))
+MARKET_DATA_LATENCY_JITTER_MS = float(os.getenv("MARKET_DATA_LATENCY_JITTER_MS", "0"))
+MARKET_DATA_ERROR_RATE = float(os.getenv("MARKET_DATA_ERROR_RATE", "0"))
+MARKET_DATA_REPLAY_FILE = os.getenv("MARKET_DATA_REPLAY_FILE")  # JSON {"AAPL": [189.2, 189.4, ...], ...}
+
+class MarketDataProvider(ABC):
+    """Source of current quotes. Prices a batch of upper-cased symbols; symbols without a quote map to None."""
+    name = "base"
+    synthetic = False  # True if prices are generated rather than real market data
+
+    @abstractmethod
+    async def get_quotes(self, symbols: List[str], low_priority: bool = False) -> Dict[str, Optional[float]]:
+        """Background callers pass low_priority so they only use upstream budget interactive requests leave."""
+        ...
+
+class FinnhubProvider(MarketDataProvider):
+    """Finnhub has no batch quote endpoint, so a batch fans out to per-symbol calls under the shared rate limiter."""
+    name = "finnhub"
+
+    async def _get_quote(self, symbol: str, low_priority: bool) -> Optional[float]:
+        try:
+            quote = await call_finnhub("quote", symbol, low_priority=low_priority)
+            price = quote.get("c")
+            if price is not None and price != 0:
+                return float(price)
+            else:
+                print(f"Price not found in Finnhub response for {symbol}. Data: {quote}")
+                return None
+        except Exception as e:
+            print(f"Error fetching price for {symbol} from Finnhub: {e}")
             return None
-    except Exception as e:
-        print(f"Error fetching price for {symbol} from Finnhub: {e}")
-        return None
+
+    async def get_quotes(self, symbols: List[str], low_priority: bool = False) -> Dict[str, Optional[float]]:
+        if finnhub_client is None:
+            return dict.fromkeys(symbols)
+        prices = await asyncio.gather(*(self._get_quote(s, low_priority) for s in symbols))
+        return dict(zip(symbols, prices))
+
+class SyntheticProvider(MarketDataProvider):
+    """
+    Deterministic offline quotes. Each symbol replays its recorded prices (cycling) or, if it has none,
+    follows a seeded random walk from a price derived from its name. Every batch waits `latency_ms`
+    (+ uniform jitter), and each symbol fails (returns None) with probability `error_rate`.
+    Sequences are per symbol, so results do not depend on how concurrent requests interleave.
+    """
+    name = "synthetic"
+    synthetic = True
+
+    def __init__(self, seed: int = 0, volatility: float = 0.002, latency_ms: float = 0.0, latency_jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, replay: Optional[Dict[str, List[float]]] = None):
+        self.seed = seed
+        self.volatility = volatility
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.replay = {symbol.upper(): [float(p) for p in prices] for symbol, prices in (replay or {}).items() if prices}
+        self._latency_rng = random.Random(seed)
+        self._rngs: Dict[str, random.Random] = {}
+        self._prices: Dict[str, float] = {}
+        self._steps: Dict[str, int] = {}
+        self.calls = 0
+        self.injected_errors = 0
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "SyntheticProvider":
+        with open(path) as f:
+            return cls(replay=json.load(f), **kwargs)
+
+    def _next_price(self, symbol: str) -> Optional[float]:
+        rng = self._rngs.get(symbol)
+        if rng is None:
+            rng = self._rngs[symbol] = random.Random(zlib.crc32(symbol.encode()) ^ self.seed)
+        if self.error_rate and rng.random() < self.error_rate:
+            self.injected_errors += 1
+            return None
+        step = self._steps.get(symbol, 0)
+        self._steps[symbol] = step + 1
+        recorded = self.replay.get(symbol)
+        if recorded:
+            return recorded[step % len(recorded)]
+        last = self._prices.get(symbol)
+        if last is None:
+            last = 50.0 + zlib.crc32(symbol.encode()) % 450
+        self._prices[symbol] = round(last * (1 + rng.gauss(0, self.volatility)), 2)
+        return self._prices[symbol]
+
+    async def get_quotes(self, symbols: List[str], low_priority: bool = False) -> Dict[str, Optional[float]]:
+        self.calls += 1
+        delay_ms = self.latency_ms + (self._latency_rng.uniform(0, self.latency_jitter_ms) if self.latency_jitter_ms else 0.0)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        return {symbol: self._next_price(symbol) for symbol in symbols}
+
+def create_market_data_provider(name: str) -> MarketDataProvider:
+    if name == "finnhub":
+        if finnhub_client is None:
+            print("WARNING: Finnhub API key not set. Stock prices will be unavailable.")
+        return FinnhubProvider()
+    if name == "synthetic":
+        options = dict(seed=MARKET_DATA_SEED, volatility=MARKET_DATA_VOLATILITY, latency_ms=MARKET_DATA_LATENCY_MS,
+                       latency_jitter_ms=MARKET_DATA_LATENCY_JITTER_MS, error_rate=MARKET_DATA_ERROR_RATE)
+        if MARKET_DATA_REPLAY_FILE:
+            return SyntheticProvider.from_file(MARKET_DATA_REPLAY_FILE, **options)
+        return SyntheticProvider(**options)
+    raise ValueError(f"Unsupported MARKET_DATA_PROVIDER: {name}")
+
+market_data = create_market_data_provider(MARKET_DATA_PROVIDER)
+
+# --- Quote cache ---
+# Quotes younger than QUOTE_CACHE_TTL are served as-is; older ones up to QUOTE_CACHE_STALE_TTL are
+# served stale while a single background refresh runs. Symbols the provider has no price for are
+# remembered for QUOTE_CACHE_NEGATIVE_TTL, so they are not refetched on every poll.
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "15"))
+QUOTE_CACHE_STALE_TTL = float(os.getenv("QUOTE_CACHE_STALE_TTL", "300"))
+QUOTE_CACHE_NEGATIVE_TTL = float(os.getenv("QUOTE_CACHE_NEGATIVE_TTL", "60"))
+QUOTE_CACHE_MAX_SIZE = int(os.getenv("QUOTE_CACHE_MAX_SIZE", "5000"))
+
+class QuoteCache:
+    """Bounded LRU+TTL cache of prices keyed by symbol, with stale-while-revalidate and single-flight loads."""
+    def __init__(self, loader, ttl: float, stale_ttl: float, max_size: int, negative_ttl: float = 0.0):
+        self._loader = loader
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # symbol -> (price, fetched_at, version); price is None for a remembered "no quote"
+        self._entries: "OrderedDict[str, tuple[Optional[float], float, int]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._version = 0  # bumped whenever a symbol's price changes
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def get(self, symbol: str) -> Optional[float]:
+        symbol = symbol.upper()
+        return (await self.get_many([symbol]))[symbol]
+
+    async def get_many(self, symbols: List[str]) -> Dict[str, Optional[float]]:
+        """Serve fresh and stale symbols from cache and load all misses in one batch. Keys are upper-cased."""
+        results: Dict[str, Optional[float]] = {}
+        stale: List[str] = []
+        missing: List[str] = []
+        now = time.monotonic()
+        for symbol in dict.fromkeys(s.upper() for s in symbols):
+            entry = self._entries.get(symbol)
+            if entry is not None:
+                price, fetched_at, _ = entry
+                age = now - fetched_at
+                if price is None:
+                    if age < self.negative_ttl:
+                        self._entries.move_to_end(symbol)
+                        self.hits += 1
+                        results[symbol] = None
+                        continue
+                elif age < self.stale_ttl:
+                    self._entries.move_to_end(symbol)
+                    if age < self.ttl:
+                        self.hits += 1
+                    else:
+                        self.stale_hits += 1
+                        stale.append(symbol)
+                    results[symbol] = price
+                    continue
+            self.misses += 1
+            missing.append(symbol)
+        if stale:
+            self._load(stale)
+        if missing:
+            tasks = self._load(missing)
+            for task in set(tasks.values()):
+                # Shield so a cancelled request does not cancel the load other waiters share
+                prices = await asyncio.shield(task)
+                for symbol, symbol_task in tasks.items():
+                    if symbol_task is task:
+                        results[symbol] = prices.get(symbol)
+        return results
+
+    def _load(self, symbols: List[str]) -> Dict[str, asyncio.Task]:
+        """Return the in-flight load for each symbol, starting one batch load for those with none running."""
+        pending = [s for s in symbols if s not in self._inflight]
+        if pending:
+            task = asyncio.create_task(self._run_loader(pending))
+            for symbol in pending:
+                self._inflight[symbol] = task
+        return {symbol: self._inflight[symbol] for symbol in symbols}
+
+    async def _run_loader(self, symbols: List[str]) -> Dict[str, Optional[float]]:
+        try:
+            prices = await self._loader(symbols)
+            for symbol, price in prices.items():
+                if price is not None:
+                    self.set(symbol, price)
+                else:
+                    self.set_missing(symbol)
+            return prices
+        except Exception as e:
+            logger.warning("Quote load failed for %d symbols: %s", len(symbols), e)
+            return {}
+        finally:
+            for symbol in symbols:
+                self._inflight.pop(symbol, None)
+
+    def set(self, symbol: str, price: float):
+        self._store(symbol, price)
+
+    def set_missing(self, symbol: str):
+        """Remember that the provider has no quote, unless a known price can still be served stale."""
+        if self.negative_ttl > 0 and self._entries.get(symbol, (None,))[0] is None:
+            self._store(symbol, None)
+
+    def _store(self, symbol: str, price: Optional[float]):
+        entry = self._entries.get(symbol)
+        if entry is not None and entry[0] == price:
+            version = entry[2]
+        else:
+            self._version += 1
+            version = self._version
+        self._entries[symbol] = (price, time.monotonic(), version)
+        self._entries.move_to_end(symbol)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def fresh(self, symbols: List[str]) -> Dict[str, Optional[float]]:
+        """Cached prices still within their TTL (including remembered misses), without counting lookups."""
+        now = time.monotonic()
+        results = {}
+        for symbol in symbols:
+            entry = self._entries.get(symbol)
+            if entry is not None and now - entry[1] < (self.ttl if entry[0] is not None else self.negative_ttl):
+                results[symbol] = entry[0]
+        return results
+
+    def versions(self, symbols: List[str]) -> List[Optional[int]]:
+        """Per-symbol version of the cached price (None if not cached); it only changes when the price does."""
+        return [entry[2] if (entry := self._entries.get(symbol)) is not None else None for symbol in symbols]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            "inflight": len(self._inflight),
+        }
+
+async def load_quotes(symbols: List[str]) -> Dict[str, Optional[float]]:
+    with STAGE_LATENCY.time(stage="quote_batch"):
+        return await market_data.get_quotes(symbols)
+
+quote_cache = QuoteCache(load_quotes, ttl=QUOTE_CACHE_TTL, stale_ttl=QUOTE_CACHE_STALE_TTL, max_size=QUOTE_CACHE_MAX_SIZE,
+                         negative_ttl=QUOTE_CACHE_NEGATIVE_TTL)
+
+async def get_current_stock_price(symbol: str) -> Optional[float]:
+    """Returns the current stock price for a symbol, served from the quote cache when fresh enough."""
+    return await quote_cache.get(symbol)
+
+async def get_current_stock_prices(symbols: List[str]) -> Dict[str, Optional[float]]:
+    """Fetches current prices for many symbols, loading cache misses in one provider batch. Keyed by upper-cased symbol."""
+    return await quote_cache.get_many(symbols)
+
+# --- Portfolio valuation ---
+class PortfolioValuation:
+    """
+    In-memory holdings, last known prices and market values with a running grand total for one portfolio.
+    Price ticks and holding mutations update it in O(1), so reads never rescan the stocks table.
+    Values are tracked in integer cents so the running total does not drift.
+    State is per process: writes must go through the endpoints of this app to be reflected.
+    """
+    def __init__(self, portfolio_id: int, holders: Dict[str, set], generation: int = 0):
+        self.portfolio_id = portfolio_id
+        self.generation = generation  # unique per load, so versions restarting at 0 never repeat a tag
+        self._holders = holders  # shared symbol -> {portfolio_id} index owned by ValuationRegistry
+        self.holdings: Dict[str, tuple] = {}  # symbol -> (quantity, unit_cost), in portfolio order
+        self.prices: Dict[str, float] = {}
+        self._value_cents: Dict[str, int] = {}
+        self.grand_total_cents = 0
+        self.cash = 0.0
+        self.version = 0  # bumped on every holding or cash change
+        self.price_version = 0  # bumped on every price change
+        self.context_cache: Optional[tuple] = None  # (key, assistant portfolio context)
+        self.arrays_cache = None  # PortfolioArrays for analytics, rebuilt when version changes
+        self.analytics_cache: Optional[tuple] = None  # (key, PortfolioAnalyticsResponse)
+        self.response_cache: Optional[tuple] = None  # (etag, serialized PortfolioDetailResponse)
+
+    async def load(self, session: AsyncSession, prices: Dict[str, float]):
+        """Load holdings and cash from the database, seeding values from already known prices."""
+        result = await session.execute(HOLDINGS_BY_PORTFOLIO, {"portfolio_id": self.portfolio_id})
+        self.clear()
+        for row in result.all():
+            if row.symbol in prices:
+                self.prices[row.symbol] = prices[row.symbol]
+            self.set_holding(row.symbol, row.quantity, row.unit_cost)
+        result = await session.execute(CASH_BY_PORTFOLIO, {"portfolio_id": self.portfolio_id})
+        self.cash = result.scalar_one_or_none() or 0.0
+
+    def _revalue(self, symbol: str):
+        self.grand_total_cents -= self._value_cents.pop(symbol, 0)
+        holding = self.holdings.get(symbol)
+        price = self.prices.get(symbol)
+        if holding is not None and price is not None:
+            cents = round(round(price * holding[0], 2) * 100)
+            self._value_cents[symbol] = cents
+            self.grand_total_cents += cents
+
+    def set_holding(self, symbol: str, quantity: float, unit_cost: Optional[float] = None):
+        self.holdings[symbol] = (quantity, unit_cost)
+        self._holders.setdefault(symbol, set()).add(self.portfolio_id)
+        self._revalue(symbol)
+        self.version += 1
+
+    def remove_holding(self, symbol: str):
+        self.holdings.pop(symbol, None)
+        self._drop_holder(symbol)
+        self._revalue(symbol)
+        self.version += 1
+
+    def _drop_holder(self, symbol: str):
+        holders = self._holders.get(symbol)
+        if holders is not None:
+            holders.discard(self.portfolio_id)
+            if not holders:
+                del self._holders[symbol]
+
+    def clear(self):
+        for symbol in self.holdings:
+            self._drop_holder(symbol)
+        self.holdings.clear()
+        self._value_cents.clear()
+        self.grand_total_cents = 0
+        self.version += 1
+
+    def set_cash(self, cash: float):
+        self.cash = cash
+        self.version += 1
+
+    def set_price(self, symbol: str, price: Optional[float]) -> bool:
+        """Apply a price tick; returns True if it changed this portfolio's valuation."""
+        if price is None or self.prices.get(symbol) == price:
+            return False
+        self.prices[symbol] = price
+        self._revalue(symbol)
+        self.price_version += 1
+        return True
+
+    @property
+    def grand_total(self) -> float:
+        return self.grand_total_cents / 100
+
+    @property
+    def fully_priced(self) -> bool:
+        """True once every holding has a known price, i.e. the grand total covers the whole portfolio."""
+        return len(self._value_cents) == len(self.holdings)
+
+    def item(self, symbol: str) -> StockPortfolioItem:
+        quantity, unit_cost = self.holdings[symbol]
+        cents = self._value_cents.get(symbol)
+        current_total_value = cents / 100 if cents is not None else None
+        percentage_of_portfolio = None
+        if current_total_value is not None and self.grand_total_cents > 0:
+            percentage_of_portfolio = round(cents / self.grand_total_cents * 100, 2)
+        return StockPortfolioItem(
+            symbol=symbol,
+            quantity=quantity,
+            unit_cost=unit_cost,
+            current_price=self.prices.get(symbol) if cents is not None else None,
+            current_total_value=current_total_value,
+            percentage_of_portfolio=percentage_of_portfolio
+        )
+
+    def response(self) -> PortfolioDetailResponse:
+        return PortfolioDetailResponse(
+            stocks=[self.item(symbol) for symbol in self.holdings],
+            grand_total_portfolio_value=self.grand_total,
+            cash=self.cash
+        )
+
+class ValuationRegistry:
+    """
+    Lazily loaded PortfolioValuation per portfolio, plus a symbol -> portfolios index so one
+    price tick is applied to every portfolio holding the symbol without scanning the others.
+    """
+    def __init__(self):
+        self.valuations: Dict[int, PortfolioValuation] = {}
+        self.holders: Dict[str, set] = {}
+        self.prices: Dict[str, float] = {}  # last known price per symbol, shared by all portfolios
+        self.generations = 0  # bumped per loaded valuation; ids and versions can repeat after a delete
+        self._load_lock = asyncio.Lock()
+
+    async def get(self, session: AsyncSession, portfolio_id: int) -> Optional[PortfolioValuation]:
+        """Return the loaded valuation for a portfolio, or None if the portfolio does not exist."""
+        valuation = self.valuations.get(portfolio_id)
+        if valuation is not None:
+            return valuation
+        async with self._load_lock:
+            valuation = self.valuations.get(portfolio_id)
+            if valuation is not None:
+                return valuation
+            if await session.get(Portfolio, portfolio_id) is None:
+                return None
+            self.generations += 1
+            valuation = PortfolioValuation(portfolio_id, self.holders, self.generations)
+            with STAGE_LATENCY.time(stage="portfolio_load"):
+                await valuation.load(session, self.prices)
+            self.valuations[portfolio_id] = valuation
+            return valuation
+
+    def drop(self, portfolio_id: int):
+        valuation = self.valuations.pop(portfolio_id, None)
+        if valuation is not None:
+            valuation.clear()
+
+    def set_price(self, symbol: str, price: Optional[float]) -> List[PortfolioValuation]:
+        """Apply a price to every loaded portfolio holding the symbol; returns the ones that changed."""
+        if price is None:
+            return []
+        self.prices[symbol] = price
+        changed = []
+        for portfolio_id in self.holders.get(symbol, ()):
+            valuation = self.valuations.get(portfolio_id)
+            if valuation is not None and valuation.set_price(symbol, price):
+                changed.append(valuation)
+        return changed
+
+valuation_registry = ValuationRegistry()
+
+async def get_portfolio_valuation(
+    portfolio_id: int = Query(DEFAULT_PORTFOLIO_ID, description="Portfolio to operate on"),
+    session: AsyncSession = Depends(get_session)
+) -> PortfolioValuation:
+    """Dependency resolving ?portfolio_id= to its loaded valuation (404 if the portfolio does not exist)."""
+    valuation = await valuation_registry.get(session, portfolio_id)
+    if valuation is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    return valuation
+
+async def refresh_valuation_prices(symbols: List[str]):
+    """Price the given symbols through the shared quote cache and apply them to every portfolio holding them."""
+    prices = await get_current_stock_prices(symbols)
+    for symbol, price in prices.items():
+        valuation_registry.set_price(symbol, price)
+
+# --- Price streaming ---
+# A single background poller keeps prices for every held symbol warm and pushes changes to
+# subscribed clients, so upstream load scales with symbols rather than symbols x clients x polls.
+PRICE_STREAM_ENABLED = os.getenv("PRICE_STREAM_ENABLED", "true").lower() in ("1", "true", "yes")
+PRICE_STREAM_INTERVAL = float(os.getenv("PRICE_STREAM_INTERVAL", "30"))
+
+class PriceStreamer:
+    """Background task that polls prices for held symbols and fans out changes to SSE subscribers."""
+    def __init__(self, provider: MarketDataProvider, interval: float):
+        self.provider = provider
+        self.interval = interval
+        self._subscribers: Dict[int, set] = {}  # portfolio_id -> subscriber queues
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, portfolio_id: int) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+        self._subscribers.setdefault(portfolio_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, portfolio_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(portfolio_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[portfolio_id]
+
+    def publish(self, portfolio_id: int, event: dict):
+        for queue in self._subscribers.get(portfolio_id, ()):
+            if queue.full():
+                # Slow client: drop its oldest update rather than block the poller
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception:
+                logger.exception("Price stream poll failed")
+            await asyncio.sleep(self.interval)
+
+    async def poll_once(self):
+        # Each distinct symbol is priced once per poll, however many portfolios hold it
+        async with async_session() as session:
+            result = await session.execute(HELD_SYMBOLS)
+            symbols = list(result.scalars().all())
+        if not symbols:
+            return
+        # Symbols a request priced moments ago are not refetched; the rest go upstream at low priority,
+        # so a large poll never holds up interactive quote loads
+        fresh = quote_cache.fresh(symbols)
+        due = [symbol for symbol in symbols if symbol not in fresh]
+        fetched = await self.provider.get_quotes(due, low_priority=True) if due else {}
+        for symbol, price in fetched.items():
+            if price is not None:
+                quote_cache.set(symbol, price)
+            else:
+                quote_cache.set_missing(symbol)
+        prices = {**fresh, **fetched}
+        if not self.provider.synthetic:
+            await asyncio.to_thread(price_history.record_snapshot, prices)
+        changed: Dict[int, List[str]] = {}
+        for symbol, price in prices.items():
+            for valuation in valuation_registry.set_price(symbol, price):
+                changed.setdefault(valuation.portfolio_id, []).append(symbol)
+        for portfolio_id, changed_symbols in changed.items():
+            valuation = valuation_registry.valuations[portfolio_id]
+            deltas = [valuation.item(symbol).model_dump() for symbol in changed_symbols]
+            self.publish(portfolio_id, {"stocks": deltas, "grand_total_portfolio_value": valuation.grand_total})
+
+price_streamer = PriceStreamer(market_data, interval=PRICE_STREAM_INTERVAL)
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/portfolios/", response_model=PortfolioResponse)
+async def create_portfolio(portfolio: PortfolioCreate, session: AsyncSession = Depends(get_session)):
+    """Create a new, empty portfolio. Pass its id as ?portfolio_id= to the /portfolio endpoints."""
+    new_portfolio = Portfolio(name=portfolio.name, owner=portfolio.owner)
+    session.add(new_portfolio)
+    await session.flush()
+    session.add(PortfolioMeta(portfolio_id=new_portfolio.id, cash=0.0))
+    await session.commit()
+    return PortfolioResponse(id=new_portfolio.id, name=new_portfolio.name, owner=new_portfolio.owner)
+
+@app.get("/portfolios/", response_model=List[PortfolioResponse])
+async def list_portfolios(owner: Optional[str] = None, session: AsyncSession = Depends(get_session)):
+    """List portfolios, optionally only those belonging to one owner."""
+    query = select(Portfolio).order_by(Portfolio.id)
+    if owner is not None:
+        query = query.where(Portfolio.owner == owner)
+    result = await session.execute(query)
+    return [PortfolioResponse(id=p.id, name=p.name, owner=p.owner) for p in result.scalars().all()]
+
+@app.delete("/portfolios/{portfolio_id}")
+async def delete_portfolio(portfolio_id: int = Path(..., description="Portfolio id"), session: AsyncSession = Depends(get_session)):
+    """Delete a portfolio with its holdings and cash. The default portfolio, and one with jobs in flight, cannot be deleted."""
+    if portfolio_id == DEFAULT_PORTFOLIO_ID:
+        raise HTTPException(status_code=400, detail="The default portfolio cannot be deleted")
+    portfolio = await session.get(Portfolio, portfolio_id)
+    if not portfolio:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    if job_queue.has_active(portfolio_id):
+        raise HTTPException(status_code=409, detail="Portfolio has queued or running jobs, try again when they finish")
+    await session.execute(sa.delete(Stock).where(Stock.portfolio_id == portfolio_id))
+    await session.execute(sa.delete(PortfolioMeta).where(PortfolioMeta.portfolio_id == portfolio_id))
+    await session.delete(portfolio)
+    await session.commit()
+    valuation_registry.drop(portfolio_id)
+    return {"detail": f"Portfolio {portfolio_id} deleted."}
 
 @app.post("/portfolio/stocks/", response_model=StockBase)
-async def add_stock_manually(stock: StockBase, session: AsyncSession = Depends(get_session)):
+async def add_stock_manually(stock: StockBase, valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
     """Manually add a stock to the portfolio or update quantity if symbol exists."""
-    result = await session.execute(select(Stock).where(Stock.symbol == stock.symbol.upper()))
+    result = await session.execute(STOCK_BY_PORTFOLIO_SYMBOL, {"portfolio_id": valuation.portfolio_id, "symbol": stock.symbol.upper()})
     existing_stock = result.scalar_one_or_none()
     if existing_stock:
         existing_stock.quantity += stock.quantity
         await session.commit()
         await session.refresh(existing_stock)
+        valuation.set_holding(existing_stock.symbol, existing_stock.quantity, existing_stock.unit_cost)
         return StockBase(symbol=existing_stock.symbol, quantity=existing_stock.quantity)
-    new_stock = Stock(symbol=stock.symbol.upper(), quantity=stock.quantity)
+    new_stock = Stock(portfolio_id=valuation.portfolio_id, symbol=stock.symbol.upper(), quantity=stock.quantity)
     session.add(new_stock)
     await session.commit()
     await session.refresh(new_stock)
+    valuation.set_holding(new_stock.symbol, new_stock.quantity, new_stock.unit_cost)
     return StockBase(symbol=new_stock.symbol, quantity=new_stock.quantity)
 
+# --- Conditional responses ---
+# ETags embed a per-process id, so versions restarting from zero after a restart never match old tags.
+APP_INSTANCE_ID = uuid.uuid4().hex[:8]
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def portfolio_json_response(request: Request, valuation: PortfolioValuation) -> Response:
+    """
+    Serialize the portfolio at most once per (holdings version, price version): answers a matching
+    If-None-Match with 304, otherwise reuses the cached JSON body for that version.
+    """
+    etag = f'"{APP_INSTANCE_ID}-{valuation.portfolio_id}.{valuation.generation}-{valuation.version}-{valuation.price_version}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    if valuation.response_cache is None or valuation.response_cache[0] != etag:
+        with STAGE_LATENCY.time(stage="portfolio_serialize"):
+            valuation.response_cache = (etag, valuation.response().model_dump_json().encode())
+    return Response(content=valuation.response_cache[1], media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
 @app.get("/portfolio/stocks/", response_model=PortfolioDetailResponse)
-async def get_portfolio_with_details(session: AsyncSession = Depends(get_session)):
-    result = await session.execute(select(Stock))
-    stocks_in_db = result.scalars().all()
-    detailed_portfolio_items: List[StockPortfolioItem] = []
-    grand_total_portfolio_value: float = 0.0
-
-    # First pass: Fetch prices and calculate individual total values
-    for stock_in_db in stocks_in_db:
-        current_price = await get_current_stock_price(stock_in_db.symbol)
-        current_total_value = None
-        if current_price is not None:
-            current_total_value = round(current_price * stock_in_db.quantity, 2)
-            grand_total_portfolio_value += current_total_value
-        detailed_portfolio_items.append(
-            StockPortfolioItem(
-                symbol=stock_in_db.symbol,
-                quantity=stock_in_db.quantity,
-                current_price=current_price,
-                current_total_value=current_total_value
-            )
-        )
+async def get_portfolio_with_details(request: Request, valuation: PortfolioValuation = Depends(get_portfolio_valuation)):
+    """Return every holding with current price, value and weight, served from the in-memory valuation. Supports ETag/If-None-Match."""
+    with STAGE_LATENCY.time(stage="price_refresh"):
+        await refresh_valuation_prices(list(valuation.holdings))
+    return portfolio_json_response(request, valuation)
 
-    # Second pass: Calculate percentage_of_portfolio for each stock
-    if grand_total_portfolio_value > 0: # Avoid division by zero
-        for item in detailed_portfolio_items:
-            if item.current_total_value is not None:
-                item.percentage_of_portfolio = round((item.current_total_value / grand_total_portfolio_value) * 100, 2)
+QUOTES_MAX_SYMBOLS = int(os.getenv("QUOTES_MAX_SYMBOLS", "200"))
 
-    # Fetch cash
-    result = await session.execute(select(PortfolioMeta))
-    meta = result.scalar_one_or_none()
-    cash = meta.cash if meta else 0.0
+class QuotesResponse(BaseModel):
+    quotes: Dict[str, Optional[float]]
 
-    return PortfolioDetailResponse(
-        stocks=detailed_portfolio_items,
-        grand_total_portfolio_value=round(grand_total_portfolio_value, 2) if grand_total_portfolio_value > 0 else 0.0,
-        cash=cash
-    )
+@app.get("/quotes", response_model=QuotesResponse)
+async def get_quotes(request: Request, symbols: str = Query(..., description="Comma-separated symbols, e.g. AAPL,MSFT")):
+    """Current prices for many symbols in one call, served through the shared quote cache. Supports ETag/If-None-Match."""
+    requested = [s.strip().upper() for s in symbols.split(",") if s.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="No symbols given")
+    if len(requested) > QUOTES_MAX_SYMBOLS:
+        raise HTTPException(status_code=400, detail=f"At most {QUOTES_MAX_SYMBOLS} symbols per request")
+    prices = await get_current_stock_prices(requested)
+    for symbol, price in prices.items():
+        valuation_registry.set_price(symbol, price)
+    # Tag from the requested symbols and their quote versions, so an unchanged answer is never re-serialized
+    tag_source = f"{','.join(prices)}|{quote_cache.versions(list(prices))}".encode()
+    etag = f'"{APP_INSTANCE_ID}-{hashlib.sha1(tag_source).hexdigest()[:16]}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    body = QuotesResponse(quotes=prices).model_dump_json().encode()
+    return Response(content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@app.get("/quotes/cache-stats")
+async def get_quote_cache_stats():
+    """Report quote cache size and hit/miss counters."""
+    return quote_cache.stats()
 
 @app.get("/test-connection")
 async def test_connection():
     """Test if Finnhub API key is set and can fetch a real price."""
-    print(f"FINNHUB_API_KEY: {FINNHUB_API_KEY}")
     if not FINNHUB_API_KEY:
         return JSONResponse(status_code=200, content={"status": "error", "message": "Finnhub API key not set."})
     try:
         price = await get_current_stock_price("AAPL")
         if price is None:
             return JSONResponse(status_code=200, content={"status": "error", "message": "Failed to fetch price. Check API key or rate limits.", "details": "No price returned from Finnhub."})
-        return {"status": "success", "message": "API key works!", "price": price}
+        return {"status": "success", "message": "API key works!", "provider": market_data.name, "price": price}
     except Exception as e:
         return JSONResponse(status_code=200, content={"status": "error", "message": "Exception occurred while fetching price.", "details": str(e)})
 
 @app.patch("/portfolio/stocks/{symbol}", response_model=StockBase)
-async def update_stock(symbol: str = Path(..., description="Stock symbol"), stock: StockBase = None, session: AsyncSession = Depends(get_session)):
+async def update_stock(symbol: str = Path(..., description="Stock symbol"), stock: StockBase = None, valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
     """Update the quantity of a stock in the portfolio."""
-    result = await session.execute(select(Stock).where(Stock.symbol == symbol.upper()))
+    result = await session.execute(STOCK_BY_PORTFOLIO_SYMBOL, {"portfolio_id": valuation.portfolio_id, "symbol": symbol.upper()})
     existing_stock = result.scalar_one_or_none()
     if not existing_stock:
         raise HTTPException(status_code=404, detail="Stock not found")
@@ -200,70 +1141,75 @@ async def update_stock(symbol: str = Path(..., description="Stock symbol"), stoc
         existing_stock.quantity = stock.quantity
         await session.commit()
         await session.refresh(existing_stock)
+        valuation.set_holding(existing_stock.symbol, existing_stock.quantity, existing_stock.unit_cost)
     return StockBase(symbol=existing_stock.symbol, quantity=existing_stock.quantity)
 
 @app.delete("/portfolio/stocks/{symbol}")
-async def delete_stock(symbol: str = Path(..., description="Stock symbol"), session: AsyncSession = Depends(get_session)):
+async def delete_stock(symbol: str = Path(..., description="Stock symbol"), valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
     """Delete a stock from the portfolio by symbol."""
-    result = await session.execute(select(Stock).where(Stock.symbol == symbol.upper()))
+    result = await session.execute(STOCK_BY_PORTFOLIO_SYMBOL, {"portfolio_id": valuation.portfolio_id, "symbol": symbol.upper()})
     existing_stock = result.scalar_one_or_none()
     if not existing_stock:
         raise HTTPException(status_code=404, detail="Stock not found")
     await session.delete(existing_stock)
     await session.commit()
+    valuation.remove_holding(existing_stock.symbol)
     return {"detail": f"Stock {symbol.upper()} deleted."}
 
+@app.get("/portfolio/stream")
+async def stream_portfolio_prices(request: Request, valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
+    """Server-Sent Events stream: a full `snapshot` event, then `prices` events carrying only changed holdings."""
+    await refresh_valuation_prices(list(valuation.holdings))
+    snapshot = valuation.response()
+    await session.close()
+    portfolio_id = valuation.portfolio_id
+    queue = price_streamer.subscribe(portfolio_id)
+
+    async def event_stream():
+        try:
+            yield _sse_event("snapshot", snapshot.model_dump())
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse_event("prices", event)
+        finally:
+            price_streamer.unsubscribe(portfolio_id, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.get("/portfolio/stocks/refresh", response_model=PortfolioDetailResponse)
-async def refresh_portfolio_prices(session: AsyncSession = Depends(get_session)):
+async def refresh_portfolio_prices(request: Request, valuation: PortfolioValuation = Depends(get_portfolio_valuation)):
     """Explicitly refresh and return the portfolio with updated prices (does not modify DB)."""
-    return await get_portfolio_with_details(session)
+    return await get_portfolio_with_details(request, valuation)
 
 @app.get("/portfolio/stocks/{symbol}", response_model=StockPortfolioItem)
-async def get_stock_with_details(symbol: str = Path(..., description="Stock symbol"), session: AsyncSession = Depends(get_session)):
+async def get_stock_with_details(symbol: str = Path(..., description="Stock symbol"), valuation: PortfolioValuation = Depends(get_portfolio_valuation)):
     """Retrieve a single stock in the portfolio with current price, total value, and percentage of portfolio."""
-    result = await session.execute(select(Stock).where(Stock.symbol == symbol.upper()))
-    stock_in_db = result.scalar_one_or_none()
-    if not stock_in_db:
+    symbol = symbol.upper()
+    if symbol not in valuation.holdings:
         raise HTTPException(status_code=404, detail="Stock not found")
-    current_price = await get_current_stock_price(stock_in_db.symbol)
-    if current_price is None:
-        current_price_for_calc = 0.0
+    if valuation.fully_priced:
+        valuation_registry.set_price(symbol, await get_current_stock_price(symbol))
     else:
-        current_price_for_calc = current_price
-    current_total_value = None
-    if current_price is not None:
-        current_total_value = round(current_price * stock_in_db.quantity, 2)
-    # Calculate grand total for percentage (fetch all stocks, but don't fetch their prices)
-    result_all = await session.execute(select(Stock))
-    stocks_in_db = result_all.scalars().all()
-    grand_total_portfolio_value = 0.0
-    for s in stocks_in_db:
-        if s.symbol == stock_in_db.symbol and current_total_value is not None:
-            grand_total_portfolio_value += current_total_value
-        else:
-            grand_total_portfolio_value += s.quantity * (current_price_for_calc if s.symbol == stock_in_db.symbol else 0)
-    percentage_of_portfolio = None
-    if grand_total_portfolio_value > 0 and current_total_value is not None:
-        percentage_of_portfolio = round((current_total_value / grand_total_portfolio_value) * 100, 2)
-    return StockPortfolioItem(
-        symbol=stock_in_db.symbol,
-        quantity=stock_in_db.quantity,
-        current_price=current_price,
-        current_total_value=current_total_value,
-        percentage_of_portfolio=percentage_of_portfolio
-    )
+        # Loaded cold (e.g. after a restart) or some holdings never priced: price them all in one batch
+        # so the weight is not taken against a partial grand total
+        await refresh_valuation_prices(list(valuation.holdings))
+    return valuation.item(symbol)
 
 @app.get("/portfolio/cash/", response_model=CashResponse)
-async def get_cash(session: AsyncSession = Depends(get_session)):
-    result = await session.execute(select(PortfolioMeta))
+async def get_cash(valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
+    result = await session.execute(META_BY_PORTFOLIO, {"portfolio_id": valuation.portfolio_id})
     meta = result.scalar_one_or_none()
     if not meta:
         raise HTTPException(status_code=404, detail="Portfolio meta not found")
     return CashResponse(cash=meta.cash)
 
 @app.put("/portfolio/cash/", response_model=CashResponse)
-async def set_cash(cash: CashResponse, session: AsyncSession = Depends(get_session)):
-    result = await session.execute(select(PortfolioMeta))
+async def set_cash(cash: CashResponse, valuation: PortfolioValuation = Depends(get_portfolio_valuation), session: AsyncSession = Depends(get_session)):
+    result = await session.execute(META_BY_PORTFOLIO, {"portfolio_id": valuation.portfolio_id})
     meta = result.scalar_one_or_none()
     if not meta:
         raise HTTPException(status_code=404, detail="Portfolio meta not found")
@@ -272,6 +1218,7 @@ async def set_cash(cash: CashResponse, session: AsyncSession = Depends(get_sessi
     meta.cash = cash.cash
     await session.commit()
     await session.refresh(meta)
+    valuation.set_cash(meta.cash)
     return CashResponse(cash=meta.cash)
 
 # --- LLM Configuration ---
@@ -290,23 +1237,62 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta/models")
 DEFAULT_GEMINI_MODEL = os.getenv("DEFAULT_GEMINI_MODEL", "gemini-pro")
 
+# Tool calling (OpenAI-compatible providers only): lets the assistant run portfolio simulations
+ASSISTANT_TOOLS_ENABLED = os.getenv("ASSISTANT_TOOLS_ENABLED", "true").lower() in ("1", "true", "yes")
+ASSISTANT_MAX_TOOL_ROUNDS = int(os.getenv("ASSISTANT_MAX_TOOL_ROUNDS", "2"))
+
+# Shared HTTP client for LLM calls: one app-lifetime pool with keep-alive and HTTP/2,
+# so requests reuse warm connections instead of paying a TCP/TLS handshake each time.
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() in ("1", "true", "yes")
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+llm_http_client: Optional[httpx.AsyncClient] = None
+
+def get_llm_http_client() -> httpx.AsyncClient:
+    global llm_http_client
+    if llm_http_client is None:
+        llm_http_client = httpx.AsyncClient(
+            http2=LLM_HTTP2,
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=10),
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS, keepalive_expiry=60),
+        )
+    return llm_http_client
+
+async def close_llm_http_client():
+    global llm_http_client
+    if llm_http_client is not None:
+        await llm_http_client.aclose()
+        llm_http_client = None
+
+def _llm_model_name() -> str:
+    if LLM_PROVIDER == "gemini":
+        return LLM_MODEL_NAME or DEFAULT_GEMINI_MODEL
+    return LLM_MODEL_NAME or DEFAULT_OPENAI_MODEL
+
+@lru_cache(maxsize=32)
+def _gemini_preamble(system_prompt: str) -> tuple:
+    """
+    Gemini wants alternating user and model roles, so the system prompt is sent as the first
+    user turn followed by a canned model acknowledgement. Built once per distinct system prompt.
+    """
+    return (
+        {"role": "user", "parts": [{"text": system_prompt}]},
+        {"role": "model", "parts": [{"text": "Understood. I am ready to assist with the portfolio."}]},
+    )
+
 class ChatMessage(BaseModel):
     role: str  # 'user' or 'assistant'
     content: str
 
 class AssistantChatRequest(BaseModel):
     messages: list[ChatMessage]
-    portfolio: dict = None  # Optional portfolio context
-
-@app.post("/assistant/chat")
-async def assistant_chat(request: AssistantChatRequest = Body(...)):
-    """Proxy chat to LLM provider, passing messages and portfolio context."""
-    system_prompt = "You are a helpful finance assistant."
-    if request.portfolio:
-        system_prompt += f"\nHere is the user's portfolio data: {request.portfolio}"
+    stream: bool = False  # Relay tokens as Server-Sent Events while they arrive
+    cache: bool = True  # Set to False to bypass the LLM response cache
 
+def _build_llm_request(request: AssistantChatRequest, system_prompt: str, stream: bool):
+    """Return (url, headers, payload) for the configured LLM provider."""
     if LLM_PROVIDER == "openai":
-        actual_model = LLM_MODEL_NAME or DEFAULT_OPENAI_MODEL
+        actual_model = _llm_model_name()
         api_key = OPENAI_API_KEY
         api_base = OPENAI_API_BASE
         if not api_key:
@@ -325,134 +1311,642 @@ async def assistant_chat(request: AssistantChatRequest = Body(...)):
             ],
             "temperature": 0.7
         }
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, headers=headers, json=payload, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
-            return {"reply": data["choices"][0]["message"]["content"]}
+        if ASSISTANT_TOOLS_ENABLED:
+            payload["tools"] = ASSISTANT_TOOLS
+        if stream:
+            payload["stream"] = True
+        return url, headers, payload
 
     elif LLM_PROVIDER == "gemini":
-        actual_model = LLM_MODEL_NAME or DEFAULT_GEMINI_MODEL
+        actual_model = _llm_model_name()
         api_key = GEMINI_API_KEY
         api_base = GEMINI_API_BASE
         if not api_key:
             raise HTTPException(status_code=500, detail="Gemini API key (GEMINI_API_KEY) not configured.")
 
-        url = f"{api_base}/{actual_model}:generateContent?key={api_key}"
-        # Gemini expects a specific structure for messages and system prompt handling
-        contents = []
-        # Add system prompt as the first user message part if it's not implicitly handled by the model
-        # For Gemini, it's better to prepend it to the first user message or have a specific turn.
-        # Here, we'll prepend it to the history before the user's actual messages.
-        
-        # Convert messages to Gemini format
-        # System prompt is handled by being part of the overall prompt history.
-        # The initial system prompt is a user turn, then assistant response, then user query.
-        # We will build the Gemini `contents` list from the request.messages, prefixing the system_prompt.
-
-        gemini_messages = [] 
-        # Start with the system prompt as the initial context for the model.
-        # Gemini usually takes history in pairs of user/model.
-        # If the first message from history is user, we can prepend system context there.
-        # If it's assistant (e.g. initial greeting), system prompt could be a preceding user turn.
-
-        # Simplified: add system prompt as a separate user turn if messages don't cover it.
-        # For now, the system prompt is part of the first user message for Gemini for simplicity.
-        # Let's adjust the payload based on typical Gemini API interactions.
-        
-        # Construct history for Gemini: it wants alternating user and model roles.
-        # The very first instruction can be a user role.
-        gemini_contents = [{"role": "user", "parts": [{"text": system_prompt}]}]
-        if request.messages:
-            # Add a model part to complete the first turn if system_prompt was the user part
-            gemini_contents.append({"role": "model", "parts": [{"text": "Understood. I am ready to assist with the portfolio."}]}) 
-
+        if stream:
+            url = f"{api_base}/{actual_model}:streamGenerateContent?alt=sse&key={api_key}"
+        else:
+            url = f"{api_base}/{actual_model}:generateContent?key={api_key}"
+        preamble = _gemini_preamble(system_prompt)
+        # The model acknowledgement only completes the first turn when user messages follow
+        gemini_contents = list(preamble if request.messages else preamble[:1])
         for msg in request.messages:
             role = "user" if msg.role == "user" else "model"
             gemini_contents.append({"role": role, "parts": [{"text": msg.content}]})
 
         payload = {"contents": gemini_contents}
         headers = {"Content-Type": "application/json"}
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, headers=headers, json=payload, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
-            reply = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-            return {"reply": reply}
+        return url, headers, payload
     else:
         raise HTTPException(status_code=400, detail=f"LLM provider '{LLM_PROVIDER}' not supported yet.")
 
-@app.post("/portfolio/import-csv/")
-async def import_portfolio_csv(
-    file: UploadFile = File(...),
-    mode: str = Form("replace"),
-    session: AsyncSession = Depends(get_session)
-):
+def _first_choice(data: dict) -> dict:
+    """First OpenAI choice, or {} for chunks that carry none (usage totals, prompt-filter results)."""
+    return (data.get("choices") or [{}])[0]
+
+def _extract_llm_text(data: dict, stream: bool) -> str:
+    """Pull the reply text (or, for stream chunks, the text delta) out of a provider response."""
+    if LLM_PROVIDER == "openai":
+        choice = _first_choice(data)
+        if stream:
+            return choice.get("delta", {}).get("content") or ""
+        return choice.get("message", {}).get("content") or ""
+    candidate = (data.get("candidates") or [{}])[0]
+    return (candidate.get("content", {}).get("parts") or [{}])[0].get("text", "")
+
+async def _post_llm_request(url: str, headers: dict, payload: dict) -> dict:
+    try:
+        with UPSTREAM_LATENCY.time(service=LLM_PROVIDER, method="chat"):
+            resp = await get_llm_http_client().post(url, headers=headers, json=payload)
+            resp.raise_for_status()
+    except Exception:
+        UPSTREAM_REQUESTS.inc(service=LLM_PROVIDER, method="chat", outcome="error")
+        raise
+    UPSTREAM_REQUESTS.inc(service=LLM_PROVIDER, method="chat", outcome="ok")
+    return resp.json()
+
+async def _stream_llm_reply(url: str, headers: dict, payload: dict, cache_key: Optional[str] = None, run_tool=None):
     """
-    Import portfolio from a CSV file. Mode can be 'replace' (clear all and import) or 'append' (upsert by symbol).
-    CSV columns: 代號 (Symbol), 股數 (Quantity), 單位成本 (Unit Cost)
+    Relay provider stream chunks to the browser as `token` SSE events, ending with `done` (or `error`).
+    If the model calls tools, a `tool` event is sent, run_tool(name, arguments) runs them and the
+    follow-up reply is streamed. The full reply is stored under cache_key once the stream completes.
     """
-    content = await file.read()
-    # Try utf-8, then big5, then gbk
-    for encoding in ["utf-8", "big5", "gbk"]:
-        try:
-            decoded = content.decode(encoding)
+    parts = []
+    start = time.perf_counter()
+    try:
+        for tool_round in range(ASSISTANT_MAX_TOOL_ROUNDS + 1):
+            tool_calls: Dict[int, dict] = {}
+            async with get_llm_http_client().stream("POST", url, headers=headers, json=payload) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if run_tool is not None:
+                        _collect_tool_call_deltas(chunk, tool_calls)
+                    text = _extract_llm_text(chunk, stream=True)
+                    if text:
+                        if not parts:
+                            STAGE_LATENCY.observe(time.perf_counter() - start, stage="llm_first_token")
+                        parts.append(text)
+                        yield _sse_event("token", {"text": text})
+            if not tool_calls:
+                break
+            for call in tool_calls.values():
+                yield _sse_event("tool", {"name": call["function"]["name"]})
+            payload = await _with_tool_results(payload, list(tool_calls.values()), run_tool, tool_round + 1 < ASSISTANT_MAX_TOOL_ROUNDS)
+        UPSTREAM_REQUESTS.inc(service=LLM_PROVIDER, method="chat_stream", outcome="ok")
+        if cache_key is not None:
+            llm_response_cache.set(cache_key, "".join(parts))
+        yield _sse_event("done", {})
+    except Exception as e:
+        UPSTREAM_REQUESTS.inc(service=LLM_PROVIDER, method="chat_stream", outcome="error")
+        logger.warning("Error streaming reply from %s: %s", LLM_PROVIDER, e)
+        yield _sse_event("error", {"detail": "Error getting reply from LLM provider."})
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, service=LLM_PROVIDER, method="chat_stream")
+
+# --- LLM response cache ---
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "600"))
+LLM_CACHE_MAX_SIZE = int(os.getenv("LLM_CACHE_MAX_SIZE", "500"))
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire `ttl` seconds after they are stored."""
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, stored_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+llm_response_cache = TTLCache(ttl=LLM_CACHE_TTL, max_size=LLM_CACHE_MAX_SIZE)
+
+# Cache figures are read from the caches' own counters at scrape time
+Counter("cache_lookups_total", "Quote and LLM reply cache lookups by result (hit, stale, miss).", ("cache", "result"), collect=lambda: {
+    ("quote", "hit"): quote_cache.hits,
+    ("quote", "stale"): quote_cache.stale_hits,
+    ("quote", "miss"): quote_cache.misses,
+    ("llm", "hit"): llm_response_cache.hits,
+    ("llm", "miss"): llm_response_cache.misses,
+})
+Gauge("cache_entries", "Entries currently held per cache.", ("cache",), collect=lambda: {
+    ("quote",): quote_cache.stats()["size"],
+    ("llm",): llm_response_cache.stats()["size"],
+})
+Gauge("quote_loads_in_flight", "Symbols with a quote load in flight.", collect=lambda: {(): quote_cache.stats()["inflight"]})
+
+def _llm_cache_key(request: AssistantChatRequest, system_prompt: str) -> str:
+    """Key on provider, model, the system prompt (which carries the portfolio context) and normalized messages."""
+    messages = [(m.role.strip().lower(), " ".join(m.content.split()).casefold()) for m in request.messages]
+    portfolio_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+    raw = json.dumps([LLM_PROVIDER, _llm_model_name(), portfolio_hash, messages], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+@app.get("/assistant/cache-stats")
+async def get_llm_cache_stats():
+    """Report LLM response cache size and hit/miss counters."""
+    return llm_response_cache.stats()
+
+# --- Assistant portfolio context ---
+# The portfolio context is built server-side from the valuation state as a compact CSV table,
+# largest positions first, with small positions past the token budget folded into one summary line.
+ASSISTANT_CONTEXT_TOKEN_BUDGET = int(os.getenv("ASSISTANT_CONTEXT_TOKEN_BUDGET", "1500"))
+
+def _compact_number(value: Optional[float]) -> str:
+    if value is None:
+        return ""
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English/CSV text
+    return len(text) // 4 + 1
+
+def build_portfolio_context(valuation: PortfolioValuation, token_budget: int = ASSISTANT_CONTEXT_TOKEN_BUDGET) -> str:
+    """Deterministic, compact tabular description of the portfolio for the assistant prompt, cached per portfolio version."""
+    key = (valuation.version, valuation.price_version, token_budget)
+    if valuation.context_cache is not None and valuation.context_cache[0] == key:
+        return valuation.context_cache[1]
+
+    items = [valuation.item(symbol) for symbol in valuation.holdings]
+    items.sort(key=lambda item: (-(item.current_total_value or 0.0), item.symbol))
+    lines = [
+        f"Portfolio: total_value={_compact_number(valuation.grand_total)} cash={_compact_number(valuation.cash)} positions={len(items)}",
+        "symbol,quantity,price,value,weight_pct,unit_cost",
+    ]
+    used = sum(_estimate_tokens(line) for line in lines)
+    # Reserve room for the summary line in case the tail has to be folded
+    tail_reserve = _estimate_tokens("+00000 smaller positions: value=000000000.00 weight_pct=100.00")
+    included = 0
+    for index, item in enumerate(items):
+        row = ",".join([
+            item.symbol,
+            _compact_number(item.quantity),
+            _compact_number(item.current_price),
+            _compact_number(item.current_total_value),
+            _compact_number(item.percentage_of_portfolio),
+            _compact_number(item.unit_cost),
+        ])
+        cost = _estimate_tokens(row)
+        is_last = index == len(items) - 1
+        if used + cost + (0 if is_last else tail_reserve) > token_budget:
             break
-        except Exception:
-            decoded = None
-    if decoded is None:
-        return {"error": "Could not decode CSV file. Please use UTF-8, Big5, or GBK encoding."}
-    # Normalize all whitespace in headers and values
-    def normalize(s):
-        if s is None:
-            return None
-        s = unicodedata.normalize('NFKC', s)
-        s = s.replace('\u00A0', ' ').replace('\ufeff', '')  # Remove non-breaking space and BOM
-        return s.strip()
-    reader = csv.DictReader(StringIO(decoded))
-    # Normalize fieldnames
-    reader.fieldnames = [normalize(h) for h in reader.fieldnames]
-    added, updated, skipped, errors = 0, 0, 0, []
-    rows = list(reader)
-    # Diagnostic: capture headers and first row
-    debug_headers = reader.fieldnames
-    debug_first_row = rows[0] if rows else {}
-    def get_val(row, *keys):
-        for k in keys:
-            for rk in row:
-                if normalize(rk) == normalize(k):
-                    return normalize(row[rk])
+        lines.append(row)
+        used += cost
+        included += 1
+    tail = items[included:]
+    if tail:
+        tail_value = sum(item.current_total_value or 0.0 for item in tail)
+        tail_weight = tail_value / valuation.grand_total * 100 if valuation.grand_total > 0 else 0.0
+        lines.append(f"+{len(tail)} smaller positions: value={_compact_number(tail_value)} weight_pct={_compact_number(tail_weight)}")
+    context = "\n".join(lines)
+    valuation.context_cache = (key, context)
+    return context
+
+# --- Assistant tools ---
+ASSISTANT_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "simulate_portfolio",
+        "description": (
+            "Simulate hypothetical trades, or a rebalance to target weights, on the user's current portfolio. "
+            "Returns the resulting cash, market value, realized and unrealized P&L, concentration (HHI), "
+            "changed positions with their new weights, and the buy/sell list needed."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "scenarios": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "trades": {
+                                "type": "array",
+                                "description": "Give each trade exactly one of quantity, value or fraction.",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "symbol": {"type": "string"},
+                                        "quantity": {"type": "number", "description": "Shares to buy (positive) or sell (negative)"},
+                                        "value": {"type": "number", "description": "Money to buy (positive) or sell (negative) at the last price"},
+                                        "fraction": {"type": "number", "description": "Fraction of the current position to buy (positive) or sell (negative); -0.5 sells half"},
+                                    },
+                                    "required": ["symbol"],
+                                },
+                            },
+                            "target_weights": {
+                                "type": "object",
+                                "additionalProperties": {"type": "number"},
+                                "description": "Instead of trades: symbol -> percent of total value (holdings + cash). Unlisted holdings are sold; the rest stays cash.",
+                            },
+                            "keep_unlisted": {"type": "boolean", "description": "With target_weights, keep unlisted holdings as they are"},
+                        },
+                    },
+                },
+                "whole_shares": {"type": "boolean", "description": "Round trades to whole shares"},
+            },
+            "required": ["scenarios"],
+        },
+    },
+}]
+
+async def run_assistant_tool(valuation: PortfolioValuation, name: str, arguments: str) -> str:
+    """Run one tool call from the model; the JSON result (or error) becomes the tool message content."""
+    if name != "simulate_portfolio":
+        return json.dumps({"error": f"Unknown tool: {name}"})
+    try:
+        return await simulate_portfolio(valuation, SimulationRequest.model_validate_json(arguments or "{}"), exclude_none=True)
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+
+def _collect_tool_call_deltas(chunk: dict, tool_calls: Dict[int, dict]):
+    """Accumulate streamed tool-call fragments into complete calls, keyed by their index."""
+    for delta in _first_choice(chunk).get("delta", {}).get("tool_calls") or []:
+        call = tool_calls.setdefault(delta.get("index", 0), {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+        if delta.get("id"):
+            call["id"] = delta["id"]
+        function = delta.get("function") or {}
+        call["function"]["name"] += function.get("name") or ""
+        call["function"]["arguments"] += function.get("arguments") or ""
+
+async def _with_tool_results(payload: dict, tool_calls: list, run_tool, allow_more_tools: bool) -> dict:
+    """Follow-up payload carrying the model's tool calls and their results; tools are withheld on the last round."""
+    messages = [*payload["messages"], {"role": "assistant", "content": None, "tool_calls": tool_calls}]
+    for call in tool_calls:
+        with STAGE_LATENCY.time(stage="assistant_tool"):
+            content = await run_tool(call["function"]["name"], call["function"]["arguments"])
+        messages.append({"role": "tool", "tool_call_id": call["id"], "content": content})
+    follow_up = {**payload, "messages": messages}
+    if not allow_more_tools:
+        follow_up.pop("tools", None)
+    return follow_up
+
+@app.post("/assistant/chat")
+async def assistant_chat(request: AssistantChatRequest = Body(...), valuation: PortfolioValuation = Depends(get_portfolio_valuation)):
+    """
+    Proxy chat to LLM provider, passing messages and the server-built portfolio context. Streams SSE when `stream` is set.
+    With OpenAI-compatible providers the model can call simulate_portfolio for what-if questions.
+    """
+    system_prompt = "You are a helpful finance assistant."
+    if ASSISTANT_TOOLS_ENABLED and LLM_PROVIDER == "openai":
+        system_prompt += " For what-if trades or rebalancing questions, call simulate_portfolio instead of estimating."
+    if valuation.holdings or valuation.cash:
+        # Price first so the context (and any cached reply keyed on it) reflects current values
+        await refresh_valuation_prices(list(valuation.holdings))
+        system_prompt += f"\nHere is the user's portfolio as CSV:\n{build_portfolio_context(valuation)}"
+
+    url, headers, payload = _build_llm_request(request, system_prompt, stream=request.stream)
+    run_tool = (lambda name, arguments: run_assistant_tool(valuation, name, arguments)) if "tools" in payload else None
+    cache_key = _llm_cache_key(request, system_prompt) if request.cache else None
+    cached_reply = llm_response_cache.get(cache_key) if cache_key is not None else None
+    if request.stream:
+        if cached_reply is not None:
+            events = [_sse_event("token", {"text": cached_reply}), _sse_event("done", {})]
+            return StreamingResponse(iter(events), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+        return StreamingResponse(_stream_llm_reply(url, headers, payload, cache_key, run_tool), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    if cached_reply is not None:
+        return {"reply": cached_reply}
+    data = await _post_llm_request(url, headers, payload)
+    for tool_round in range(ASSISTANT_MAX_TOOL_ROUNDS if run_tool is not None else 0):
+        tool_calls = _first_choice(data).get("message", {}).get("tool_calls")
+        if not tool_calls:
+            break
+        payload = await _with_tool_results(payload, tool_calls, run_tool, tool_round + 1 < ASSISTANT_MAX_TOOL_ROUNDS)
+        data = await _post_llm_request(url, headers, payload)
+    reply = _extract_llm_text(data, stream=False)
+    if cache_key is not None:
+        llm_response_cache.set(cache_key, reply)
+    return {"reply": reply}
+
+# --- Background jobs ---
+# Long-running work (CSV imports, history backfills) runs on a bounded pool of in-process workers;
+# the submitting request returns a job id at once. Jobs live in memory and do not survive a restart.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+
+class Job:
+    """A unit of background work. `func(job)` does the work and may update `job.progress` as it goes."""
+    def __init__(self, kind: str, func, portfolio_id: Optional[int] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.func = func
+        self.portfolio_id = portfolio_id
+        self.status = "queued"  # queued -> running -> succeeded | failed
+        self.progress: dict = {}
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+class JobResponse(BaseModel):
+    id: str
+    kind: str
+    status: str
+    portfolio_id: Optional[int] = None
+    progress: dict
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class JobQueue:
+    """
+    Bounded in-process job queue drained by a fixed pool of worker tasks. Jobs for the same portfolio
+    run one at a time, so two imports never interleave their writes. A portfolio's next job waits in
+    its own pending queue and only becomes ready when the previous one finishes, so workers only
+    ever pick up jobs they can run right away.
+    """
+    def __init__(self, workers: int, max_queued: int, retention: float):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self.jobs: Dict[str, Job] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[int, deque] = {}  # portfolio_id -> jobs waiting behind its ready or running job
+        self._queued = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, kind: str, func, portfolio_id: Optional[int] = None) -> Job:
+        """Queue a job; raises HTTPException(503) when the queue is full."""
+        self._prune()
+        if self._queued >= self.max_queued:
+            raise HTTPException(status_code=503, detail="Too many queued jobs, try again later")
+        job = Job(kind, func, portfolio_id)
+        self._queued += 1
+        self.jobs[job.id] = job
+        if portfolio_id is None:
+            self._ready.put_nowait(job)
+        elif portfolio_id in self._pending:
+            self._pending[portfolio_id].append(job)
+        else:
+            self._pending[portfolio_id] = deque()
+            self._ready.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def has_active(self, portfolio_id: int) -> bool:
+        """Whether the portfolio has a job queued or running."""
+        return portfolio_id in self._pending
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self.jobs.values() if j.finished_at is not None and j.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def _release(self, portfolio_id: Optional[int]):
+        """Make the portfolio's next pending job ready, or mark the portfolio idle."""
+        if portfolio_id is None:
+            return
+        pending = self._pending[portfolio_id]
+        if pending:
+            self._ready.put_nowait(pending.popleft())
+        else:
+            del self._pending[portfolio_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._ready.get()
+            self._queued -= 1
+            try:
+                job.status = "running"
+                job.started_at = time.time()
+                with STAGE_LATENCY.time(stage=f"job_{job.kind}"):
+                    job.result = await job.func(job)
+                job.status = "succeeded"
+            except asyncio.CancelledError:
+                job.status, job.error = "failed", "Server shut down before the job finished."
+                raise
+            except Exception as e:
+                logger.warning("Job %s (%s) failed: %s", job.id, job.kind, e)
+                job.status, job.error = "failed", str(e)
+            finally:
+                job.finished_at = time.time()
+                self._release(job.portfolio_id)
+
+    def response(self, job: Job) -> JobResponse:
+        return JobResponse(
+            id=job.id, kind=job.kind, status=job.status, portfolio_id=job.portfolio_id, progress=job.progress,
+            result=job.result, error=job.error, created_at=job.created_at, started_at=job.started_at, finished_at=job.finished_at,
+        )
+
+job_queue = JobQueue(workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, retention=JOB_RETENTION_SECONDS)
+
+def _count_jobs() -> dict:
+    counts: Dict[tuple, int] = {}
+    for job in job_queue.jobs.values():
+        counts[(job.kind, job.status)] = counts.get((job.kind, job.status), 0) + 1
+    return counts
+
+Gauge("jobs", "Retained background jobs by kind and status.", ("kind", "status"), collect=_count_jobs)
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str = Path(..., description="Job id returned when the job was submitted")):
+    """Poll a background job's status, progress and, once finished, its result or error."""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_queue.response(job)
+
+# --- CSV import ---
+CSV_IMPORT_CHUNK_SIZE = int(os.getenv("CSV_IMPORT_CHUNK_SIZE", "500"))
+CSV_IMPORT_ENCODINGS = ["utf-8", "big5", "gbk"]
+# Accepted header names for each column, in lookup order
+CSV_IMPORT_COLUMNS = {
+    "symbol": ("代號", "Symbol"),
+    "quantity": ("股數", "Quantity"),
+    "unit_cost": ("單位成本", "Unit Cost"),
+}
+
+def _normalize_csv_text(s: Optional[str]) -> Optional[str]:
+    """Normalize all whitespace in CSV headers and values."""
+    if s is None:
         return None
-    if mode == "replace":
-        await session.execute(sa.delete(Stock))
-        await session.commit()
-    for row in rows:
-        symbol = get_val(row, "代號", "Symbol")
-        quantity = get_val(row, "股數", "Quantity")
-        unit_cost = get_val(row, "單位成本", "Unit Cost")
-        if not symbol or not quantity:
-            skipped += 1
-            continue
+    s = unicodedata.normalize('NFKC', s)
+    s = s.replace('\u00A0', ' ').replace('\ufeff', '')  # Remove non-breaking space and BOM
+    return s.strip()
+
+def _detect_csv_encoding(fileobj) -> Optional[str]:
+    """Return the first of CSV_IMPORT_ENCODINGS that decodes the whole file, reading it in chunks."""
+    for encoding in CSV_IMPORT_ENCODINGS:
+        fileobj.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)()
         try:
-            symbol = normalize(symbol).upper()
-            quantity = float(quantity.replace(',', ''))
-            unit_cost_val = float(unit_cost.replace(',', '')) if unit_cost not in (None, "") else None
-        except Exception as e:
-            errors.append(f"Row error for symbol {symbol}: {e}")
-            skipped += 1
+            while chunk := fileobj.read(64 * 1024):
+                decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+            return encoding
+        except UnicodeDecodeError:
             continue
-        # Upsert logic
-        result = await session.execute(select(Stock).where(Stock.symbol == symbol))
-        stock = result.scalar_one_or_none()
-        if stock:
-            stock.quantity = quantity
-            stock.unit_cost = unit_cost_val
-            updated += 1
-        else:
-            stock = Stock(symbol=symbol, quantity=quantity, unit_cost=unit_cost_val)
-            session.add(stock)
-            added += 1
-    await session.commit()
+    return None
+
+def _resolve_csv_columns(headers: List[str]) -> Dict[str, Optional[int]]:
+    """Map each logical column to its index in the (normalized) header row, once per file."""
+    normalized = [_normalize_csv_text(h) for h in headers]
+    columns = {}
+    for column, names in CSV_IMPORT_COLUMNS.items():
+        columns[column] = next((normalized.index(n) for n in names if n in normalized), None)
+    return columns
+
+async def _upsert_stock_chunk(session: AsyncSession, portfolio_id: int, chunk: Dict[str, tuple]) -> set:
+    """Upsert one chunk of {symbol: (quantity, unit_cost)} in a single statement; returns the symbols that already existed."""
+    result = await session.execute(
+        select(Stock.symbol).where(Stock.portfolio_id == portfolio_id, Stock.symbol.in_(list(chunk)))
+    )
+    existing = set(result.scalars().all())
+    stmt = dialect_insert(Stock).values([
+        {"portfolio_id": portfolio_id, "symbol": symbol, "quantity": quantity, "unit_cost": unit_cost}
+        for symbol, (quantity, unit_cost) in chunk.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Stock.portfolio_id, Stock.symbol],
+        set_={"quantity": stmt.excluded.quantity, "unit_cost": stmt.excluded.unit_cost},
+    )
+    await session.execute(stmt)
+    return existing
+
+async def import_csv_file(job: Job, fileobj, mode: str, valuation: PortfolioValuation) -> dict:
+    """
+    Parse the CSV incrementally and write it in chunked upserts inside one transaction. The in-memory
+    valuation is updated only after the commit, so a failed import leaves both untouched.
+    """
+    import_start = time.perf_counter()
+    bytes_total = fileobj.seek(0, io.SEEK_END)
+    job.progress = {"rows": 0, "bytes_read": 0, "bytes_total": bytes_total, "percent": 0.0}
+    with STAGE_LATENCY.time(stage="csv_import_decode"):
+        # Decoding reads the whole file, so keep it off the event loop
+        encoding = await asyncio.to_thread(_detect_csv_encoding, fileobj)
+    if encoding is None:
+        fileobj.close()
+        raise ValueError("Could not decode CSV file. Please use UTF-8, Big5, or GBK encoding.")
+    fileobj.seek(0)
+    text = io.TextIOWrapper(fileobj, encoding=encoding, newline="")
+    added, updated, skipped, errors = 0, 0, 0, []
+    rows = 0
+
+    def report_progress():
+        bytes_read = min(fileobj.tell(), bytes_total)
+        job.progress = {"rows": rows, "bytes_read": bytes_read, "bytes_total": bytes_total,
+                        "percent": round(100 * bytes_read / bytes_total, 1) if bytes_total else 100.0}
+
+    try:
+        async with async_session() as session:
+            try:
+                reader = csv.reader(text)
+                columns = _resolve_csv_columns(next(reader, []))
+                if columns["symbol"] is None or columns["quantity"] is None:
+                    # Every row would be skipped; fail before replace mode empties the portfolio
+                    raise ValueError("CSV header must include symbol and quantity columns.")
+
+                def cell(row, column):
+                    index = columns[column]
+                    return _normalize_csv_text(row[index]) if index is not None and index < len(row) else None
+
+                # The portfolio may have been deleted while the job was queued
+                if await session.get(Portfolio, valuation.portfolio_id) is None:
+                    raise ValueError("Portfolio not found")
+                if mode == "replace":
+                    await session.execute(sa.delete(Stock).where(Stock.portfolio_id == valuation.portfolio_id))
+                imported: Dict[str, tuple] = {}
+                chunk: Dict[str, tuple] = {}
+                for row in reader:
+                    if not row:
+                        continue
+                    rows += 1
+                    symbol = cell(row, "symbol")
+                    quantity = cell(row, "quantity")
+                    unit_cost = cell(row, "unit_cost")
+                    if not symbol or not quantity:
+                        skipped += 1
+                        continue
+                    try:
+                        symbol = symbol.upper()
+                        quantity = float(quantity.replace(',', ''))
+                        unit_cost_val = float(unit_cost.replace(',', '')) if unit_cost not in (None, "") else None
+                    except Exception as e:
+                        errors.append(f"Row error for symbol {symbol}: {e}")
+                        skipped += 1
+                        continue
+                    if symbol in chunk:
+                        # Repeated symbol within the chunk: last row wins, as with the row-by-row upsert
+                        updated += 1
+                    chunk[symbol] = (quantity, unit_cost_val)
+                    imported[symbol] = chunk[symbol]
+                    if len(chunk) >= CSV_IMPORT_CHUNK_SIZE:
+                        with STAGE_LATENCY.time(stage="csv_import_upsert_chunk"):
+                            existing = await _upsert_stock_chunk(session, valuation.portfolio_id, chunk)
+                        updated += len(existing)
+                        added += len(chunk) - len(existing)
+                        chunk = {}
+                        report_progress()
+                if chunk:
+                    with STAGE_LATENCY.time(stage="csv_import_upsert_chunk"):
+                        existing = await _upsert_stock_chunk(session, valuation.portfolio_id, chunk)
+                    updated += len(existing)
+                    added += len(chunk) - len(existing)
+                with STAGE_LATENCY.time(stage="csv_import_commit"):
+                    await session.commit()
+                report_progress()
+            except Exception:
+                await session.rollback()
+                raise
+    finally:
+        text.close()
+    with STAGE_LATENCY.time(stage="csv_import_apply"):
+        if mode == "replace":
+            valuation.clear()
+        for symbol, (quantity, unit_cost_val) in imported.items():
+            valuation.set_holding(symbol, quantity, unit_cost_val)
+    STAGE_LATENCY.observe(time.perf_counter() - import_start, stage="csv_import_total")
     return {
         "added": added,
         "updated": updated,
@@ -460,4 +1954,775 @@ async def import_portfolio_csv(
         "errors": errors,
         "mode": mode,
         "total": added + updated
-    } 
\ No newline at end of file
+    }
+
+@app.post("/portfolio/import-csv/", response_model=JobResponse, status_code=202)
+async def import_portfolio_csv(
+    file: UploadFile = File(...),
+    mode: str = Form("replace"),
+    valuation: PortfolioValuation = Depends(get_portfolio_valuation)
+):
+    """
+    Queue an import of a portfolio CSV file and return the job; poll GET /jobs/{id} for progress and the result.
+    Mode can be 'replace' (clear all and import) or 'append' (upsert by symbol).
+    CSV columns: 代號 (Symbol), 股數 (Quantity), 單位成本 (Unit Cost)
+    """
+    # The upload's temp file is closed with the request, so the job gets its own copy
+    spooled = tempfile.TemporaryFile()
+    await asyncio.to_thread(shutil.copyfileobj, file.file, spooled)
+    try:
+        job = job_queue.submit("csv_import", lambda job: import_csv_file(job, spooled, mode, valuation), valuation.portfolio_id)
+    except HTTPException:
+        spooled.close()
+        raise
+    return job_queue.response(job)
+
+# --- Portfolio analytics ---
+UNKNOWN_GROUP = "Unknown"
+SYMBOL_PROFILE_MAX_PENDING = int(os.getenv("SYMBOL_PROFILE_MAX_PENDING", "100"))  # background profile fetches queued at once
+
+class SymbolProfileStore:
+    """
+    Sector and currency per symbol, kept in memory and persisted in symbol_profiles.
+    Unknown symbols are fetched from Finnhub's company profile in the background, so analytics
+    requests never wait on upstream calls; until then they are grouped under "Unknown".
+    Fetches are low priority and at most SYMBOL_PROFILE_MAX_PENDING are queued; the rest are
+    picked up by later requests once the queue drains.
+    """
+    def __init__(self):
+        self.profiles: Dict[str, tuple] = {}  # symbol -> (sector, currency)
+        self.version = 0  # bumped whenever profiles are added
+        self._checked_db: set = set()
+        self._pending: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def ensure(self, session: AsyncSession, symbols: List[str]):
+        unchecked = [s for s in symbols if s not in self.profiles and s not in self._checked_db]
+        for start in range(0, len(unchecked), 500):
+            batch = unchecked[start:start + 500]
+            result = await session.execute(select(SymbolProfile).where(SymbolProfile.symbol.in_(batch)))
+            for profile in result.scalars().all():
+                self.profiles[profile.symbol] = (profile.sector or UNKNOWN_GROUP, profile.currency or UNKNOWN_GROUP)
+            self._checked_db.update(batch)
+        if unchecked:
+            self.version += 1
+        room = SYMBOL_PROFILE_MAX_PENDING - len(self._pending)
+        missing = [s for s in symbols if s not in self.profiles and s not in self._pending][:max(room, 0)]
+        if missing and finnhub_client:
+            self._pending.update(missing)
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._fill())
+
+    def get(self, symbol: str) -> tuple:
+        return self.profiles.get(symbol, (UNKNOWN_GROUP, UNKNOWN_GROUP))
+
+    async def _fetch(self, symbol: str) -> Optional[tuple]:
+        try:
+            profile = await call_finnhub("company_profile2", symbol=symbol, low_priority=True)
+        except Exception as e:
+            logger.warning("Error fetching profile for %s from Finnhub: %s", symbol, e)
+            return None
+        # Funds and unlisted symbols have no profile; remember that instead of refetching
+        return (profile.get("finnhubIndustry") or UNKNOWN_GROUP, profile.get("currency") or UNKNOWN_GROUP)
+
+    async def _fill(self):
+        while self._pending:
+            batch = [self._pending.pop() for _ in range(min(len(self._pending), FINNHUB_MAX_CONCURRENCY))]
+            results = await asyncio.gather(*(self._fetch(symbol) for symbol in batch))
+            fetched = {symbol: profile for symbol, profile in zip(batch, results) if profile is not None}
+            if not fetched:
+                continue
+            async with async_session() as session:
+                stmt = dialect_insert(SymbolProfile).values([
+                    {"symbol": symbol, "sector": sector, "currency": currency}
+                    for symbol, (sector, currency) in fetched.items()
+                ])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[SymbolProfile.symbol],
+                    set_={"sector": stmt.excluded.sector, "currency": stmt.excluded.currency},
+                )
+                await session.execute(stmt)
+                await session.commit()
+            self.profiles.update(fetched)
+            self.version += 1
+
+symbol_profiles = SymbolProfileStore()
+
+class PositionAnalytics(BaseModel):
+    symbol: str
+    quantity: float
+    current_price: Optional[float] = None
+    market_value: Optional[float] = None
+    cost_basis: Optional[float] = None
+    unrealized_pnl: Optional[float] = None
+    unrealized_pnl_pct: Optional[float] = None
+    weight_pct: Optional[float] = None
+    sector: str
+    currency: str
+
+class GroupExposure(BaseModel):
+    name: str
+    market_value: float
+    weight_pct: float
+    positions: int
+
+class PortfolioAnalyticsResponse(BaseModel):
+    total_market_value: float
+    total_cost_basis: float  # over positions with a known unit cost
+    total_unrealized_pnl: float  # over positions with both a price and a unit cost
+    total_unrealized_pnl_pct: Optional[float] = None
+    cash: float
+    positions_count: int
+    priced_positions: int
+    hhi: Optional[float] = None  # Herfindahl-Hirschman index of position weights, 0..1
+    effective_positions: Optional[float] = None  # 1 / HHI
+    sectors: List[GroupExposure]
+    currencies: List[GroupExposure]
+    positions: Optional[List[PositionAnalytics]] = None
+
+class PortfolioArrays:
+    """Column arrays for one portfolio snapshot; holdings columns are rebuilt only when the holdings version changes."""
+    def __init__(self, valuation: PortfolioValuation):
+        self.version = valuation.version
+        self.symbols = list(valuation.holdings)
+        holdings = list(valuation.holdings.values())
+        self.quantity = np.fromiter((h[0] for h in holdings), dtype=np.float64, count=len(holdings))
+        self.unit_cost = np.fromiter((np.nan if h[1] is None else h[1] for h in holdings), dtype=np.float64, count=len(holdings))
+        self.price_version = None
+        self.price = np.full(len(holdings), np.nan)
+        self.profile_version = None
+
+    def update_prices(self, valuation: PortfolioValuation):
+        if self.price_version != valuation.price_version:
+            prices = valuation.prices
+            self.price = np.fromiter((prices.get(s, np.nan) for s in self.symbols), dtype=np.float64, count=len(self.symbols))
+            self.price_version = valuation.price_version
+
+    def update_profiles(self, store: SymbolProfileStore):
+        if self.profile_version != store.version:
+            profiles = [store.get(s) for s in self.symbols]
+            self.sector_names, self.sector_codes = np.unique(np.array([p[0] for p in profiles], dtype=object), return_inverse=True)
+            self.currency_names, self.currency_codes = np.unique(np.array([p[1] for p in profiles], dtype=object), return_inverse=True)
+            self.profile_version = store.version
+
+def _nullable_column(values, decimals: int) -> list:
+    """Round an array and return it as a list with NaN replaced by None."""
+    return [None if v != v else v for v in np.round(values, decimals).tolist()]
+
+def _group_exposures(names, codes, market_value, total: float) -> List[GroupExposure]:
+    priced = ~np.isnan(market_value)
+    values = np.bincount(codes[priced], weights=market_value[priced], minlength=len(names))
+    counts = np.bincount(codes, minlength=len(names))
+    order = np.argsort(-values, kind="stable")
+    return [
+        GroupExposure(
+            name=str(names[i]),
+            market_value=round(float(values[i]), 2),
+            weight_pct=round(float(values[i] / total * 100), 2) if total > 0 else 0.0,
+            positions=int(counts[i]),
+        )
+        for i in order
+    ]
+
+def portfolio_arrays(valuation: PortfolioValuation) -> PortfolioArrays:
+    """Return the valuation's column arrays, rebuilt if the holdings changed and repriced if prices moved."""
+    arrays = valuation.arrays_cache
+    if arrays is None or arrays.version != valuation.version:
+        arrays = valuation.arrays_cache = PortfolioArrays(valuation)
+    arrays.update_prices(valuation)
+    return arrays
+
+def compute_portfolio_analytics(valuation: PortfolioValuation, include_positions: bool = False) -> PortfolioAnalyticsResponse:
+    """Vectorized P&L, weights, concentration and group roll-ups over the portfolio's column arrays."""
+    arrays = portfolio_arrays(valuation)
+    arrays.update_profiles(symbol_profiles)
+
+    key = (arrays.version, arrays.price_version, arrays.profile_version, include_positions)
+    if valuation.analytics_cache is not None and valuation.analytics_cache[0] == key:
+        return valuation.analytics_cache[1]
+
+    market_value = arrays.quantity * arrays.price
+    cost_basis = arrays.quantity * arrays.unit_cost
+    pnl = market_value - cost_basis
+    total_value = float(np.nansum(market_value))
+    weights = market_value / total_value if total_value > 0 else np.full(len(market_value), np.nan)
+    has_pnl = ~np.isnan(pnl)
+    total_cost = float(np.nansum(cost_basis))
+    total_pnl = float(pnl[has_pnl].sum())
+    pnl_cost = float(cost_basis[has_pnl].sum())
+    priced = int(np.count_nonzero(~np.isnan(market_value)))
+    hhi = float(np.nansum(weights ** 2)) if total_value > 0 else None
+
+    positions = None
+    if include_positions:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pnl_pct = np.where(cost_basis != 0, pnl / cost_basis * 100, np.nan)
+        # Round whole columns at once and convert to Python lists before building per-position rows
+        columns = [
+            _nullable_column(arrays.price, 4),
+            _nullable_column(market_value, 2),
+            _nullable_column(cost_basis, 2),
+            _nullable_column(pnl, 2),
+            _nullable_column(pnl_pct, 2),
+            _nullable_column(weights * 100, 2),
+        ]
+        sectors = arrays.sector_names[arrays.sector_codes].tolist()
+        currencies = arrays.currency_names[arrays.currency_codes].tolist()
+        # Plain dicts are validated into PositionAnalytics by pydantic-core in one pass
+        positions = [
+            {
+                "symbol": symbol,
+                "quantity": quantity,
+                "current_price": price,
+                "market_value": value,
+                "cost_basis": cost,
+                "unrealized_pnl": position_pnl,
+                "unrealized_pnl_pct": position_pnl_pct,
+                "weight_pct": weight,
+                "sector": sector,
+                "currency": currency,
+            }
+            for symbol, quantity, price, value, cost, position_pnl, position_pnl_pct, weight, sector, currency in zip(
+                arrays.symbols, arrays.quantity.tolist(), *columns, sectors, currencies
+            )
+        ]
+
+    response = PortfolioAnalyticsResponse(
+        total_market_value=round(total_value, 2),
+        total_cost_basis=round(total_cost, 2),
+        total_unrealized_pnl=round(total_pnl, 2),
+        total_unrealized_pnl_pct=round(total_pnl / pnl_cost * 100, 2) if pnl_cost else None,
+        cash=valuation.cash,
+        positions_count=len(arrays.symbols),
+        priced_positions=priced,
+        hhi=round(hhi, 6) if hhi is not None else None,
+        effective_positions=round(1 / hhi, 2) if hhi else None,
+        sectors=_group_exposures(arrays.sector_names, arrays.sector_codes, market_value, total_value),
+        currencies=_group_exposures(arrays.currency_names, arrays.currency_codes, market_value, total_value),
+        positions=positions,
+    )
+    valuation.analytics_cache = (key, response)
+    return response
+
+@app.get("/portfolio/analytics", response_model=PortfolioAnalyticsResponse)
+async def get_portfolio_analytics(
+    include_positions: bool = Query(False, description="Include the per-position breakdown (serializing it costs 10-15 ms per 1k positions)"),
+    valuation: PortfolioValuation = Depends(get_portfolio_valuation),
+    session: AsyncSession = Depends(get_session)
+):
+    """Unrealized P&L, cost basis, weights, HHI concentration and sector/currency roll-ups from last known prices."""
+    await symbol_profiles.ensure(session, list(valuation.holdings))
+    return compute_portfolio_analytics(valuation, include_positions)
+
+# --- Portfolio simulation ---
+# What-if trades and target-weight rebalancing, evaluated against an array snapshot of the portfolio.
+# Every scenario is a sparse set of quantity changes on top of the current holdings, so totals, P&L
+# and concentration are the baseline figures plus deltas over the touched positions only.
+SIMULATION_MAX_SCENARIOS = int(os.getenv("SIMULATION_MAX_SCENARIOS", "5000"))
+# Work is bounded by (scenario, position) cells: a trade is one cell, a rebalance one per listed symbol
+# plus one per holding it sells off. Per-position output costs far more than the math, so requests
+# that return it get a smaller budget. Requests over SIMULATION_INLINE_CELLS run in a worker thread.
+SIMULATION_MAX_CELLS = int(os.getenv("SIMULATION_MAX_CELLS", "500000"))
+SIMULATION_MAX_DETAIL_CELLS = int(os.getenv("SIMULATION_MAX_DETAIL_CELLS", "50000"))
+SIMULATION_INLINE_CELLS = int(os.getenv("SIMULATION_INLINE_CELLS", "2000"))
+
+class SimulatedTrade(BaseModel):
+    symbol: str
+    quantity: Optional[float] = None  # shares to buy (+) or sell (-)
+    value: Optional[float] = None  # amount of money to buy (+) or sell (-) at the last known price
+    fraction: Optional[float] = None  # fraction of the current position to buy (+) or sell (-); -0.5 sells half
+
+class SimulationScenario(BaseModel):
+    name: Optional[str] = None
+    trades: List[SimulatedTrade] = []
+    target_weights: Optional[Dict[str, float]] = None  # symbol -> percent of total value (holdings + cash); the rest stays cash
+    keep_unlisted: bool = False  # with target_weights, leave unlisted holdings as they are instead of selling them
+
+class SimulationRequest(BaseModel):
+    scenarios: List[SimulationScenario]
+    whole_shares: bool = False  # round value, fraction and rebalancing trades toward zero to whole shares
+    min_trade_value: float = 0.0  # skip rebalancing trades worth less than this
+    summary_only: bool = False  # leave out per-scenario trades and positions
+
+class SimulatedTradeResult(BaseModel):
+    symbol: str
+    action: str  # "buy" or "sell"
+    quantity: float
+    price: float
+    value: float
+
+class SimulatedPosition(BaseModel):
+    symbol: str
+    quantity_before: float
+    quantity: float
+    market_value: float
+    weight_pct: float  # 0 when the scenario leaves no market value
+    unit_cost: Optional[float] = None
+
+class ScenarioResult(BaseModel):
+    name: Optional[str] = None
+    cash: float
+    total_market_value: float
+    total_value: float  # market value + cash
+    realized_pnl: float  # on sales of positions with a known unit cost
+    total_unrealized_pnl: float
+    hhi: Optional[float] = None
+    turnover: float  # total value traded
+    trades: Optional[List[SimulatedTradeResult]] = None
+    positions: Optional[List[SimulatedPosition]] = None  # only the positions the scenario changes
+    warnings: List[str] = []
+
+class SimulationResponse(BaseModel):
+    baseline: ScenarioResult
+    scenarios: List[ScenarioResult]
+
+# Trade kinds in the flattened trade arrays
+_TRADE_QUANTITY, _TRADE_VALUE, _TRADE_FRACTION, _TRADE_TARGET = 0, 1, 2, 3
+
+def simulation_cells(request: SimulationRequest, holdings: int) -> int:
+    """Number of (scenario, position) cells a request evaluates."""
+    cells = 0
+    for scenario in request.scenarios:
+        if scenario.target_weights is None:
+            cells += len(scenario.trades)
+        else:
+            cells += len(scenario.target_weights) + (0 if scenario.keep_unlisted else holdings)
+    return cells
+
+def run_simulation(arrays: PortfolioArrays, cash0: float, request: SimulationRequest, quotes: Dict[str, Optional[float]]) -> SimulationResponse:
+    """
+    Evaluate every scenario at once against a portfolio snapshot. `quotes` prices the symbols scenarios
+    trade that are not held. Touches no shared state, so it can run in a worker thread.
+    """
+    index = {symbol: i for i, symbol in enumerate(arrays.symbols)}
+    extra = [symbol for symbol in quotes if symbol not in index]
+    for symbol in extra:
+        index[symbol] = len(index)
+    symbols = arrays.symbols + extra
+    universe = len(symbols)
+    q0 = np.concatenate([arrays.quantity, np.zeros(len(extra))])
+    price = np.concatenate([arrays.price, np.array([np.nan if quotes[s] is None else quotes[s] for s in extra], dtype=np.float64)])
+    cost = np.concatenate([arrays.unit_cost, np.full(len(extra), np.nan)])
+
+    mv0 = q0 * price
+    total_mv0 = float(np.nansum(mv0))
+    sumsq0 = float(np.nansum(mv0 ** 2))
+    pnl0 = float(np.nansum((price - cost) * q0))
+    total_value0 = total_mv0 + cash0
+
+    # Flatten every trade and listed target weight of every scenario into parallel lists
+    scenario_ids, columns, kinds, amounts = [], [], [], []
+    sell_unlisted = []  # rebalancing scenarios whose unlisted holdings get a zero target
+    scenarios = request.scenarios
+    for s, scenario in enumerate(scenarios):
+        if scenario.target_weights is not None:
+            if scenario.trades:
+                raise ValueError(f"Scenario {s}: give either trades or target_weights, not both")
+            targets = {symbol.upper(): weight for symbol, weight in scenario.target_weights.items()}
+            if any(weight < 0 for weight in targets.values()) or sum(targets.values()) > 100 + 1e-9:
+                raise ValueError(f"Scenario {s}: target weights must be non-negative and sum to at most 100")
+            if not scenario.keep_unlisted:
+                sell_unlisted.append(s)
+            for symbol, weight in targets.items():
+                scenario_ids.append(s)
+                columns.append(index[symbol])
+                kinds.append(_TRADE_TARGET)
+                amounts.append(weight / 100)
+            continue
+        for trade in scenario.trades:
+            given = [(kind, amount) for kind, amount in ((_TRADE_QUANTITY, trade.quantity), (_TRADE_VALUE, trade.value), (_TRADE_FRACTION, trade.fraction)) if amount is not None]
+            if len(given) != 1:
+                raise ValueError(f"Scenario {s}: each trade needs exactly one of quantity, value or fraction ({trade.symbol})")
+            scenario_ids.append(s)
+            columns.append(index[trade.symbol.upper()])
+            kinds.append(given[0][0])
+            amounts.append(given[0][1])
+
+    n_scenarios = len(scenarios)
+    warnings: List[List[str]] = [[] for _ in range(n_scenarios)]
+    scenario_ids = np.asarray(scenario_ids, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    kinds = np.asarray(kinds, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    if sell_unlisted:
+        # Zero targets for every (scenario, holding) pair the scenario does not list
+        held = len(arrays.symbols)
+        fill_scenarios = np.repeat(np.asarray(sell_unlisted, dtype=np.int64), held)
+        fill_columns = np.tile(np.arange(held, dtype=np.int64), len(sell_unlisted))
+        unlisted = ~np.isin(fill_scenarios * universe + fill_columns, scenario_ids * universe + columns)
+        scenario_ids = np.concatenate([scenario_ids, fill_scenarios[unlisted]])
+        columns = np.concatenate([columns, fill_columns[unlisted]])
+        kinds = np.concatenate([kinds, np.full(int(unlisted.sum()), _TRADE_TARGET)])
+        amounts = np.concatenate([amounts, np.zeros(int(unlisted.sum()))])
+
+    # Convert each trade to a change in shares
+    trade_price = price[columns]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dq = np.select(
+            [kinds == _TRADE_QUANTITY, kinds == _TRADE_VALUE, kinds == _TRADE_FRACTION],
+            [amounts, amounts / trade_price, amounts * q0[columns]],
+            default=amounts * total_value0 / trade_price - q0[columns],
+        )
+    if request.whole_shares:
+        dq = np.where(kinds == _TRADE_QUANTITY, dq, np.trunc(dq))
+    if request.min_trade_value > 0:
+        dq = np.where((kinds == _TRADE_TARGET) & (np.abs(dq * trade_price) < request.min_trade_value), 0.0, dq)
+    unpriced = np.isnan(trade_price) & (dq != 0)
+    for i in np.flatnonzero(unpriced).tolist():
+        warnings[scenario_ids[i]].append(f"{symbols[columns[i]]}: no price available, trade skipped")
+    keep = ~unpriced & (dq != 0)
+
+    # Net trades per (scenario, symbol); np.unique also sorts them by scenario
+    keys, inverse = np.unique(scenario_ids[keep] * universe + columns[keep], return_inverse=True)
+    net_dq = np.bincount(inverse, weights=dq[keep], minlength=len(keys))
+    entry_scenario = keys // universe
+    entry_column = keys % universe
+    q_old = q0[entry_column]
+    q_new = q_old + net_dq
+    oversold = q_new < -1e-9
+    for i in np.flatnonzero(oversold).tolist():
+        warnings[entry_scenario[i]].append(f"{symbols[entry_column[i]]}: sells more than the {q_old[i]:g} shares held; sold the whole position")
+    q_new = np.maximum(q_new, 0.0)
+    changed = q_new != q_old
+    entry_scenario, entry_column, q_old, q_new = entry_scenario[changed], entry_column[changed], q_old[changed], q_new[changed]
+
+    p = price[entry_column]
+    c = cost[entry_column]
+    traded = q_new - q_old
+    trade_value = traded * p
+    sold = np.maximum(-traded, 0.0)
+    bought = np.maximum(traded, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Buys move the average cost; sells realize P&L against it and leave it unchanged
+        c_new = np.where(bought > 0, np.where(q_old > 0, (q_old * c + bought * p) / q_new, p), c)
+    mv_old = q_old * p
+    mv_new = q_new * p
+
+    def per_scenario(values):
+        return np.bincount(entry_scenario, weights=values, minlength=n_scenarios)
+
+    cash = cash0 - per_scenario(trade_value)
+    turnover = per_scenario(np.abs(trade_value))
+    realized = per_scenario(np.where(np.isnan(c), 0.0, sold * (p - c)))
+    total_mv = total_mv0 + per_scenario(mv_new - mv_old)
+    sumsq = sumsq0 + per_scenario(mv_new ** 2 - mv_old ** 2)
+    unrealized = pnl0 + per_scenario(np.where(np.isnan(c_new), 0.0, (p - c_new) * q_new) - np.where(np.isnan(c), 0.0, (p - c) * q_old))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hhi = np.where(total_mv > 0, sumsq / total_mv ** 2, np.nan)
+        # A scenario that sells everything has no market value left to weigh against
+        weight_pct = np.where(total_mv[entry_scenario] > 0, mv_new / total_mv[entry_scenario] * 100, 0.0)
+
+    bounds = np.searchsorted(entry_scenario, np.arange(n_scenarios + 1)).tolist()
+    if not request.summary_only:
+        entry_symbols = [symbols[i] for i in entry_column.tolist()]
+        entry_columns = [
+            q_old.tolist(), np.round(q_new, 6).tolist(), np.round(traded, 6).tolist(), np.round(p, 4).tolist(),
+            np.round(trade_value, 2).tolist(), np.round(mv_new, 2).tolist(), np.round(weight_pct, 2).tolist(), _nullable_column(c_new, 4),
+        ]
+    results = []
+    for s, scenario in enumerate(scenarios):
+        if cash[s] < -0.005:
+            warnings[s].append(f"Cash goes negative ({cash[s]:.2f})")
+        trades = positions = None
+        if not request.summary_only:
+            start, end = bounds[s], bounds[s + 1]
+            rows = list(zip(entry_symbols[start:end], *(column[start:end] for column in entry_columns)))
+            # Sells first: they fund the buys
+            trades = [
+                {"symbol": symbol, "action": "buy" if delta > 0 else "sell", "quantity": abs(delta), "price": px, "value": abs(value)}
+                for symbol, _, _, delta, px, value, _, _, _ in sorted(rows, key=lambda row: row[5])
+            ]
+            positions = [
+                {"symbol": symbol, "quantity_before": before, "quantity": after, "market_value": value, "weight_pct": weight, "unit_cost": unit_cost}
+                for symbol, before, after, _, _, _, value, weight, unit_cost in rows
+            ]
+        results.append(ScenarioResult(
+            name=scenario.name,
+            cash=round(float(cash[s]), 2),
+            total_market_value=round(float(total_mv[s]), 2),
+            total_value=round(float(total_mv[s] + cash[s]), 2),
+            realized_pnl=round(float(realized[s]), 2),
+            total_unrealized_pnl=round(float(unrealized[s]), 2),
+            hhi=None if np.isnan(hhi[s]) else round(float(hhi[s]), 6),
+            turnover=round(float(turnover[s]), 2),
+            trades=trades,
+            positions=positions,
+            warnings=warnings[s],
+        ))
+    baseline = ScenarioResult(
+        name="current",
+        cash=round(cash0, 2),
+        total_market_value=round(total_mv0, 2),
+        total_value=round(total_value0, 2),
+        realized_pnl=0.0,
+        total_unrealized_pnl=round(pnl0, 2),
+        hhi=round(sumsq0 / total_mv0 ** 2, 6) if total_mv0 > 0 else None,
+        turnover=0.0,
+    )
+    return SimulationResponse(baseline=baseline, scenarios=results)
+
+def simulation_json(response: SimulationResponse, exclude_none: bool = False) -> str:
+    """Serialize scenario by scenario, so a worker thread gives up the GIL between scenarios."""
+    scenarios = ",".join(scenario.model_dump_json(exclude_none=exclude_none) for scenario in response.scenarios)
+    return f'{{"baseline":{response.baseline.model_dump_json(exclude_none=exclude_none)},"scenarios":[{scenarios}]}}'
+
+async def simulate_portfolio(valuation: PortfolioValuation, request: SimulationRequest, exclude_none: bool = False) -> str:
+    """
+    Price the holdings and any new symbols through the quote cache, run the scenarios and return the
+    SimulationResponse as JSON. Large requests are simulated and serialized in a worker thread.
+    """
+    if len(request.scenarios) > SIMULATION_MAX_SCENARIOS:
+        raise ValueError(f"At most {SIMULATION_MAX_SCENARIOS} scenarios per request")
+    cells = simulation_cells(request, len(valuation.holdings))
+    max_cells = SIMULATION_MAX_CELLS if request.summary_only else SIMULATION_MAX_DETAIL_CELLS
+    if cells > max_cells:
+        raise ValueError(f"Request covers {cells} scenario positions; at most {max_cells} per request" + ("" if request.summary_only else " without summary_only"))
+    await refresh_valuation_prices(list(valuation.holdings))
+    new_symbols = {
+        symbol.upper()
+        for scenario in request.scenarios
+        for symbol in [t.symbol for t in scenario.trades] + list(scenario.target_weights or ())
+    } - valuation.holdings.keys()
+    quotes = await get_current_stock_prices(list(new_symbols)) if new_symbols else {}
+    # Shallow copy: later price ticks replace the cached arrays' columns instead of writing into them
+    arrays, cash = copy.copy(portfolio_arrays(valuation)), valuation.cash
+
+    def simulate() -> str:
+        return simulation_json(run_simulation(arrays, cash, request, quotes), exclude_none)
+
+    if cells > SIMULATION_INLINE_CELLS:
+        return await asyncio.to_thread(simulate)
+    return simulate()
+
+@app.post("/portfolio/simulate", response_model=SimulationResponse)
+async def simulate_portfolio_trades(request: SimulationRequest = Body(...), valuation: PortfolioValuation = Depends(get_portfolio_valuation)):
+    """
+    What-if trades and rebalancing against current holdings, cash and cached prices. Each scenario lists
+    trades or target weights; results give cash, value, P&L, concentration and the trades needed.
+    """
+    try:
+        body = await simulate_portfolio(valuation, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=body, media_type="application/json")
+
+# --- Price history ---
+# Daily closes and intraday snapshots per symbol, stored as columnar binary files (int64 epoch
+# seconds + float64 closes, sorted by time) and read through np.memmap, so range queries are a
+# binary search over the mapped file instead of a rescan or an upstream refetch.
+PRICE_HISTORY_DIR = os.getenv("PRICE_HISTORY_DIR", "./price_history")
+PRICE_HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("PRICE_HISTORY_SNAPSHOT_INTERVAL", "300"))
+# Each mapped series holds two open files; least recently used series are unmapped beyond this
+PRICE_HISTORY_MAX_OPEN_SERIES = int(os.getenv("PRICE_HISTORY_MAX_OPEN_SERIES", "128"))
+HISTORY_RESOLUTIONS = ("daily", "intraday")
+SECONDS_PER_DAY = 86400
+
+class PriceHistoryStore:
+    """
+    Append-mostly columnar price history per (resolution, symbol).
+    Writes run in worker threads; each one holds the lock for a single series, so readers on the
+    event loop never see a half-written series and wait at most one write.
+    """
+    def __init__(self, root: str, max_open: int = PRICE_HISTORY_MAX_OPEN_SERIES):
+        self.root = root
+        self.max_open = max_open
+        self._mapped: "OrderedDict[tuple, tuple]" = OrderedDict()  # (resolution, symbol) -> (timestamps, closes) memmaps
+        self._last: Dict[tuple, Optional[int]] = {}  # (resolution, symbol) -> last timestamp
+        self._lock = threading.RLock()
+
+    def _paths(self, resolution: str, symbol: str) -> tuple:
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", symbol)
+        directory = os.path.join(self.root, resolution)
+        return os.path.join(directory, f"{name}.ts"), os.path.join(directory, f"{name}.close")
+
+    def series(self, resolution: str, symbol: str) -> tuple:
+        """Return (timestamps, closes) for a symbol, memory-mapped and sorted by time."""
+        key = (resolution, symbol)
+        with self._lock:
+            if key in self._mapped:
+                self._mapped.move_to_end(key)
+                return self._mapped[key]
+            ts_path, close_path = self._paths(resolution, symbol)
+            if os.path.exists(ts_path) and os.path.getsize(ts_path) > 0:
+                timestamps = np.memmap(ts_path, dtype=np.int64, mode="r")
+                closes = np.memmap(close_path, dtype=np.float64, mode="r", shape=timestamps.shape)
+            else:
+                timestamps, closes = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            self._mapped[key] = (timestamps, closes)
+            # Dropping the cache's reference unmaps the files once no caller still holds the arrays
+            while len(self._mapped) > self.max_open:
+                self._mapped.popitem(last=False)
+            return timestamps, closes
+
+    def last_timestamp(self, resolution: str, symbol: str) -> Optional[int]:
+        key = (resolution, symbol)
+        if key not in self._last:
+            timestamps, _ = self.series(resolution, symbol)
+            self._last[key] = int(timestamps[-1]) if len(timestamps) else None
+        return self._last[key]
+
+    def bounds(self, resolution: str, symbol: str) -> Optional[tuple]:
+        timestamps, _ = self.series(resolution, symbol)
+        return (int(timestamps[0]), int(timestamps[-1])) if len(timestamps) else None
+
+    def append(self, resolution: str, symbol: str, timestamp: int, close: float):
+        """Append a point after the tail; a point at the tail's timestamp overwrites its close. Blocking."""
+        with self._lock:
+            last = self.last_timestamp(resolution, symbol)
+            if last is not None and timestamp < last:
+                return
+            ts_path, close_path = self._paths(resolution, symbol)
+            os.makedirs(os.path.dirname(ts_path), exist_ok=True)
+            if timestamp == last:
+                with open(close_path, "r+b") as f:
+                    f.seek(-8, os.SEEK_END)
+                    f.write(np.float64(close).tobytes())
+            else:
+                with open(ts_path, "ab") as f:
+                    f.write(np.int64(timestamp).tobytes())
+                with open(close_path, "ab") as f:
+                    f.write(np.float64(close).tobytes())
+            self._last[(resolution, symbol)] = timestamp
+            self._mapped.pop((resolution, symbol), None)
+
+    def merge(self, resolution: str, symbol: str, timestamps, closes) -> int:
+        """Merge a batch of points (e.g. a backfill) into the series; new points win on equal timestamps. Blocking."""
+        with self._lock:
+            old_ts, old_close = self.series(resolution, symbol)
+            all_ts = np.concatenate([np.asarray(timestamps, dtype=np.int64), old_ts])
+            all_close = np.concatenate([np.asarray(closes, dtype=np.float64), old_close])
+            # np.unique keeps the first occurrence, i.e. the new point
+            merged_ts, first = np.unique(all_ts, return_index=True)
+            merged_close = all_close[first]
+            added = len(merged_ts) - len(old_ts)
+            self._mapped.pop((resolution, symbol), None)
+            ts_path, close_path = self._paths(resolution, symbol)
+            os.makedirs(os.path.dirname(ts_path), exist_ok=True)
+            merged_ts.tofile(ts_path + ".tmp")
+            merged_close.tofile(close_path + ".tmp")
+            os.replace(ts_path + ".tmp", ts_path)
+            os.replace(close_path + ".tmp", close_path)
+            self._last[(resolution, symbol)] = int(merged_ts[-1]) if len(merged_ts) else None
+            return added
+
+    def window(self, resolution: str, symbol: str, start: int, end: int) -> tuple:
+        """Points in [start, end], plus the last point before start so values can be carried forward."""
+        timestamps, closes = self.series(resolution, symbol)
+        lo = max(int(np.searchsorted(timestamps, start, side="left")) - 1, 0)
+        hi = int(np.searchsorted(timestamps, end, side="right"))
+        return timestamps[lo:hi], closes[lo:hi]
+
+    def record_snapshot(self, prices: Dict[str, Optional[float]], now: Optional[float] = None):
+        """Record a refresher poll: an intraday point (throttled) and today's running daily close. Blocking."""
+        now = int(now if now is not None else time.time())
+        today = now - now % SECONDS_PER_DAY
+        for symbol, price in prices.items():
+            if price is None:
+                continue
+            last = self.last_timestamp("intraday", symbol)
+            if last is None or now - last >= PRICE_HISTORY_SNAPSHOT_INTERVAL:
+                self.append("intraday", symbol, now, price)
+            self.append("daily", symbol, today, price)
+
+price_history = PriceHistoryStore(PRICE_HISTORY_DIR)
+
+async def backfill_daily_history(symbols: List[str], days: int, job: Optional[Job] = None) -> dict:
+    """Fetch daily candles from Finnhub for the part of the range not already stored, and merge them."""
+    if not finnhub_client:
+        return {"symbols": 0, "points_added": 0, "errors": ["Finnhub API key not set."]}
+    end = int(time.time())
+    start = end - end % SECONDS_PER_DAY - days * SECONDS_PER_DAY
+
+    def missing_ranges(symbol: str) -> List[tuple]:
+        stored = price_history.bounds("daily", symbol)
+        if stored is None:
+            return [(start, end)]
+        ranges = []
+        if start < stored[0]:
+            ranges.append((start, stored[0] - 1))
+        if stored[1] + SECONDS_PER_DAY <= end:
+            ranges.append((stored[1] + SECONDS_PER_DAY, end))
+        return ranges
+
+    async def fetch(symbol: str, range_start: int, range_end: int):
+        try:
+            candles = await call_finnhub("stock_candles", symbol, "D", range_start, range_end)
+        finally:
+            if job is not None:
+                job.progress["requests_done"] += 1
+        if candles.get("s") != "ok":
+            return symbol, np.empty(0, dtype=np.int64), np.empty(0)
+        timestamps = np.asarray(candles["t"], dtype=np.int64)
+        return symbol, timestamps - timestamps % SECONDS_PER_DAY, np.asarray(candles["c"], dtype=np.float64)
+
+    requests_to_make = [(symbol, a, b) for symbol in symbols for a, b in missing_ranges(symbol)]
+    if job is not None:
+        job.progress = {"requests_done": 0, "requests_total": len(requests_to_make)}
+    results = await asyncio.gather(*(fetch(*r) for r in requests_to_make), return_exceptions=True)
+    points_added, errors = 0, []
+    for request_args, result in zip(requests_to_make, results):
+        if isinstance(result, Exception):
+            errors.append(f"Candle fetch failed for {request_args[0]}: {result}")
+            continue
+        symbol, timestamps, closes = result
+        if len(timestamps):
+            points_added += await asyncio.to_thread(price_history.merge, "daily", symbol, timestamps, closes)
+    return {"symbols": len(symbols), "requests": len(requests_to_make), "points_added": points_added, "errors": errors}
+
+class HistoryPoint(BaseModel):
+    timestamp: int  # epoch seconds (UTC); daily points are at midnight UTC
+    value: float
+
+class PortfolioHistoryResponse(BaseModel):
+    resolution: str
+    points: List[HistoryPoint]
+    missing_symbols: List[str]  # holdings with no stored prices in the range
+
+@app.get("/portfolio/history", response_model=PortfolioHistoryResponse)
+async def get_portfolio_history(
+    resolution: str = Query("daily", description="'daily' or 'intraday'"),
+    start: Optional[datetime] = Query(None, description="Range start (default: 1 year ago for daily, 1 day ago for intraday)"),
+    end: Optional[datetime] = Query(None, description="Range end (default: now)"),
+    valuation: PortfolioValuation = Depends(get_portfolio_valuation)
+):
+    """
+    Value of the current holdings over time from the local price history (cash excluded).
+    Quantities are today's; each symbol's last stored price is carried forward between points.
+    """
+    if resolution not in HISTORY_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {', '.join(HISTORY_RESOLUTIONS)}")
+    end_ts = int(end.timestamp()) if end else int(time.time())
+    default_span = 365 * SECONDS_PER_DAY if resolution == "daily" else SECONDS_PER_DAY
+    start_ts = int(start.timestamp()) if start else end_ts - default_span
+
+    windows, missing = [], []
+    for symbol, (quantity, _) in valuation.holdings.items():
+        timestamps, closes = price_history.window(resolution, symbol, start_ts, end_ts)
+        if len(timestamps) == 0:
+            missing.append(symbol)
+            continue
+        windows.append((quantity, timestamps, closes))
+    if not windows:
+        return PortfolioHistoryResponse(resolution=resolution, points=[], missing_symbols=missing)
+
+    grid = np.unique(np.concatenate([w[1] for w in windows]))
+    grid = grid[(grid >= start_ts) & (grid <= end_ts)]
+    values = np.zeros(len(grid))
+    for quantity, timestamps, closes in windows:
+        index = np.searchsorted(timestamps, grid, side="right") - 1
+        values += np.where(index >= 0, closes[np.maximum(index, 0)], 0.0) * quantity
+    points = [{"timestamp": t, "value": v} for t, v in zip(grid.tolist(), np.round(values, 2).tolist())]
+    return PortfolioHistoryResponse(resolution=resolution, points=points, missing_symbols=missing)
+
+@app.post("/portfolio/history/backfill", response_model=JobResponse, status_code=202)
+async def backfill_portfolio_history(
+    days: int = Query(365, ge=1, le=3650, description="How many days of daily candles to backfill"),
+    valuation: PortfolioValuation = Depends(get_portfolio_valuation)
+):
+    """
+    Queue a backfill of daily candles from Finnhub for every holding, fetching only ranges not already
+    stored. Returns the job; poll GET /jobs/{id} for progress and the result.
+    """
+    symbols = list(valuation.holdings)
+    job = job_queue.submit("history_backfill", lambda job: backfill_daily_history(symbols, days, job), valuation.portfolio_id)
+    return job_queue.response(job)
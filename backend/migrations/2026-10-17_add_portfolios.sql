@@ -0,0 +1,31 @@
+-- Portfolio-scoped storage: holdings and cash belong to a portfolio; existing data moves to portfolio 1.
+BEGIN;
+
+CREATE TABLE portfolios (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR NOT NULL,
+    owner VARCHAR NULL
+);
+CREATE INDEX ix_portfolios_owner ON portfolios (owner);
+INSERT INTO portfolios (id, name) VALUES (1, 'Default');
+
+-- SQLite cannot drop the UNIQUE(symbol) constraint in place, so rebuild stocks.
+CREATE TABLE stocks_new (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    portfolio_id INTEGER NOT NULL REFERENCES portfolios (id),
+    symbol VARCHAR NOT NULL,
+    quantity FLOAT NOT NULL,
+    unit_cost FLOAT NULL
+);
+INSERT INTO stocks_new (id, portfolio_id, symbol, quantity, unit_cost)
+    SELECT id, 1, symbol, quantity, unit_cost FROM stocks;
+DROP TABLE stocks;
+ALTER TABLE stocks_new RENAME TO stocks;
+CREATE UNIQUE INDEX ix_stocks_portfolio_id_symbol ON stocks (portfolio_id, symbol);
+CREATE INDEX ix_stocks_symbol ON stocks (symbol);
+
+ALTER TABLE portfolio_meta ADD COLUMN portfolio_id INTEGER NULL REFERENCES portfolios (id);
+UPDATE portfolio_meta SET portfolio_id = 1 WHERE id = (SELECT MIN(id) FROM portfolio_meta);
+CREATE UNIQUE INDEX ix_portfolio_meta_portfolio_id ON portfolio_meta (portfolio_id);
+
+COMMIT;
@@ -95,6 +95,28 @@ function App() {
     }
   }, [])
 
+  // Live price updates pushed by the backend (Server-Sent Events)
+  useEffect(() => {
+    const source = new EventSource(`${API_BASE}/portfolio/stream`)
+    source.addEventListener('prices', (e) => {
+      const update = JSON.parse(e.data)
+      const changed = Object.fromEntries(update.stocks.map(s => [s.symbol, s]))
+      const grandTotal = update.grand_total_portfolio_value
+      setPortfolio(prev => {
+        if (!prev || !prev.stocks) return prev
+        const stocks = prev.stocks.map(s => {
+          const next = changed[s.symbol] ? { ...s, ...changed[s.symbol] } : { ...s }
+          if (next.current_total_value != null && grandTotal > 0) {
+            next.percentage_of_portfolio = Math.round((next.current_total_value / grandTotal) * 10000) / 100
+          }
+          return next
+        })
+        return { ...prev, stocks, grand_total_portfolio_value: grandTotal }
+      })
+    })
+    return () => source.close()
+  }, [])
+
   useEffect(() => {
     const root = document.documentElement;
 
@@ -59,12 +59,37 @@ export default function AssistantChatPopup({ onClose, portfolio }) {
             ...messages,
             { role: 'user', content: trimmed }
           ],
-          portfolio
+          stream: true
         })
       });
-      if (!resp.ok) throw new Error('Failed to get assistant reply');
-      const data = await resp.json();
-      setMessages(msgs => [...msgs, { role: 'assistant', content: data.reply }]);
+      if (!resp.ok || !resp.body) throw new Error('Failed to get assistant reply');
+      // Read Server-Sent Events and append tokens to the reply as they arrive
+      const reader = resp.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let started = false;
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          const event = /^event: (.*)$/m.exec(raw)?.[1];
+          const data = /^data: (.*)$/m.exec(raw)?.[1];
+          if (event === 'error') throw new Error('Assistant stream failed');
+          if (event !== 'token' || !data) continue;
+          const { text } = JSON.parse(data);
+          if (!started) {
+            started = true;
+            setTyping(false);
+            setMessages(msgs => [...msgs, { role: 'assistant', content: text }]);
+          } else {
+            setMessages(msgs => [...msgs.slice(0, -1), { role: 'assistant', content: msgs[msgs.length - 1].content + text }]);
+          }
+        }
+      }
+      if (!started) setMessages(msgs => [...msgs, { role: 'assistant', content: '' }]);
     } catch (err) {
       setMessages(msgs => [...msgs, { role: 'assistant', content: 'Sorry, there was an error getting my response.' }]);
       setError('Error contacting assistant.');
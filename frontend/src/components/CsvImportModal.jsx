@@ -4,6 +4,7 @@ export default function CsvImportModal({ open, onClose, onSuccess }) {
   const [file, setFile] = useState(null);
   const [mode, setMode] = useState('replace');
   const [loading, setLoading] = useState(false);
+  const [progress, setProgress] = useState(null);
   const [result, setResult] = useState(null);
   const [error, setError] = useState('');
 
@@ -24,6 +25,7 @@ export default function CsvImportModal({ open, onClose, onSuccess }) {
     setLoading(true);
     setError('');
     setResult(null);
+    setProgress(null);
     try {
       const formData = new FormData();
       formData.append('file', file);
@@ -33,13 +35,23 @@ export default function CsvImportModal({ open, onClose, onSuccess }) {
         body: formData,
       });
       if (!resp.ok) throw new Error('Import failed');
-      const data = await resp.json();
-      setResult(data);
+      // The import runs as a background job; poll it until it finishes
+      let job = await resp.json();
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 500));
+        const jobResp = await fetch(`http://localhost:8000/jobs/${job.id}`);
+        if (!jobResp.ok) throw new Error('Import failed');
+        job = await jobResp.json();
+        setProgress(job.progress?.percent ?? null);
+      }
+      if (job.status !== 'succeeded') throw new Error(job.error || 'Import failed');
+      setResult(job.result);
       if (onSuccess) onSuccess();
     } catch (err) {
-      setError('Import failed. Please check your CSV and try again.');
+      setError(err.message && err.message !== 'Import failed' ? err.message : 'Import failed. Please check your CSV and try again.');
     } finally {
       setLoading(false);
+      setProgress(null);
     }
   };
 
@@ -60,7 +72,7 @@ export default function CsvImportModal({ open, onClose, onSuccess }) {
             </label>
           </div>
           <div style={{ display: 'flex', gap: '1em', marginTop: '1em' }}>
-            <button type="submit" disabled={loading}>{loading ? 'Importing...' : 'Import'}</button>
+            <button type="submit" disabled={loading}>{loading ? (progress !== null ? `Importing... ${Math.round(progress)}%` : 'Importing...') : 'Import'}</button>
             <button type="button" onClick={onClose} disabled={loading}>Cancel</button>
           </div>
         </form>